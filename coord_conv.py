@@ -1,26 +1,382 @@
 #!/usr/bin/python3
+#
+# This script converts coordinates between decimal degrees and
+# degrees/minutes (DM) or degrees/minutes/seconds (DMS). A single
+# lat/lon pair can be given on the command line; whole columns
+# of CSV files (e.g. particle tracks) or NetCDF variables are
+# converted in bulk, chunk by chunk, with NumPy.
+#
 
-# reqs
+
+#############################################################
+#
+# requirements
+#
+#############################################################
+
+# global reqs
 import sys
+import getopt
+import logging
+import itertools
+import contextlib
+import numpy as np
+
+# default number of values converted at once
+DEFAULT_CHUNK_SIZE = 1000000
+
+# hemisphere letters of the positive and negative values
+HEMISPHERES = {"lat": ("N", "S"), "lon": ("E", "W")}
+
+# logger
+logger = logging.getLogger('coord_conv')
+
+
+#############################################################
+#
+# printHelp
+#
+#############################################################
+
+def printHelp(logger):
+
+    logger.info("  This script converts coordinates between decimal degrees and DM/DMS.")
+    logger.info("  Usage: coord_conv.py LAT LON, or:")
+    logger.info("  --inputFile=<FILE> (.csv with a header row, or .nc)")
+    logger.info("  --columns=<NAME|INDEX[,...]> (CSV columns to convert)")
+    logger.info("  --variable=<NAME> (NetCDF variable to convert, e.g. lat or lon)")
+    logger.info("  --outputFile=<FILE> (CSV output, default: print it)")
+    logger.info("  --format=<dm|dms> (default: dm)")
+    logger.info("  --decimals=<N> (decimals of the minutes, or of the seconds, default: 2)")
+    logger.info("  --reverse (CSV only: convert the NAME_hem, NAME_deg, NAME_min[, NAME_sec] columns back to decimal NAME)")
+    logger.info("  --chunkSize=<N> (values converted at once, default: %s)" % DEFAULT_CHUNK_SIZE)
+
+
+#############################################################
+#
+# Conversions
+#
+#############################################################
+
+def decimalToDM(values, decimals=2):
+
+    """Convert decimal degrees to (sign, degrees, minutes) arrays.
+    Degrees and minutes are not negative, the sign (+1/-1) is
+    kept apart, so that e.g. -0.5 is -1, 0, 30. Minutes are
+    rounded to decimals before splitting, so that they never
+    round up to 60. NaNs give NaN degrees and minutes."""
+
+    values = np.asarray(values, dtype=np.float64)
+    sign = np.where(np.signbit(values), -1, 1)
+    total = np.round(np.abs(values) * 60, decimals)
+    degrees = np.floor(total / 60)
+    minutes = np.round(total - degrees * 60, decimals)
+    return sign, degrees, minutes
+
+
+def decimalToDMS(values, decimals=2):
+
+    """Same as decimalToDM, giving (sign, degrees, minutes,
+    seconds) arrays; minutes are integral, seconds are rounded
+    to decimals."""
+
+    values = np.asarray(values, dtype=np.float64)
+    sign = np.where(np.signbit(values), -1, 1)
+    total = np.round(np.abs(values) * 3600, decimals)
+    degrees = np.floor(total / 3600)
+    minutes = np.floor((total - degrees * 3600) / 60)
+    seconds = np.round(total - degrees * 3600 - minutes * 60, decimals)
+    return sign, degrees, minutes, seconds
+
+
+def dmsToDecimal(sign, degrees, minutes=0, seconds=0):
+
+    """Convert (sign, degrees, minutes, seconds) back to decimal
+    degrees. Negative degrees (including -0.0) are negative
+    coordinates as well as sign = -1."""
+
+    degrees = np.asarray(degrees, dtype=np.float64)
+    sign = np.where(np.signbit(degrees), -1, 1) * np.asarray(sign)
+    return sign * (np.abs(degrees) + np.asarray(minutes, dtype=np.float64) / 60 + np.asarray(seconds, dtype=np.float64) / 3600)
+
+
+def toHemisphere(sign, axis):
+
+    """Hemisphere letters (N/S for lat, E/W for lon) of signs."""
+
+    positive, negative = HEMISPHERES[axis]
+    return np.where(np.asarray(sign) < 0, negative, positive)
+
+
+def fromHemisphere(letters):
+
+    """Signs of hemisphere letters (or of +/-): -1 for S, W and -."""
+
+    letters = np.char.upper(np.char.strip(np.asarray(letters, dtype=str)))
+    return np.where(np.isin(letters, ["S", "W", "-"]), -1, 1)
+
+
+def getAxis(name):
+
+    """lat or lon, guessed from a column/variable name (lat if in
+    doubt)."""
+
+    return "lon" if name.lower().startswith(("lon", "x")) else "lat"
+
+
+#############################################################
+#
+# Streams
+#
+#############################################################
+
+def columnNames(name, fmt="dm"):
+
+    """Names of the DM/DMS columns of a coordinate."""
+
+    return [name + suffix for suffix in ("_hem", "_deg", "_min", "_sec")[:4 if fmt == "dms" else 3]]
+
+
+def formatNumbers(values, decimals=0):
+
+    """Format an array of numbers with the given decimals, as
+    "%.Nf" would, but with integer arithmetic and string ufuncs
+    instead of a Python call per value ("nan" for NaNs)."""
+
+    values = np.asarray(values, dtype=np.float64)
+    nan = np.isnan(values)
+    scale = 10 ** decimals
+    scaled = np.round(np.abs(np.where(nan, 0, values)) * scale).astype(np.int64)
+    text = (scaled // scale).astype(str)
+    if decimals:
+        text = np.char.add(np.char.add(text, "."), np.char.zfill((scaled % scale).astype(str), decimals))
+    text = np.where(values < 0, np.char.add("-", text), text)
+    return np.where(nan, "nan", text)
+
+
+def formatColumns(values, name, fmt="dm", decimals=2):
+
+    """Convert a chunk of decimal degrees to DM/DMS string columns
+    (hemisphere, degrees, minutes[, seconds], see columnNames).
+    The hemisphere of NaN values is left empty."""
+
+    axis = getAxis(name)
+    nan = np.isnan(np.asarray(values, dtype=np.float64))
+    if fmt == "dms":
+        sign, degrees, minutes, seconds = decimalToDMS(values, decimals)
+        return [np.where(nan, "", toHemisphere(sign, axis)), formatNumbers(degrees), formatNumbers(minutes), formatNumbers(seconds, decimals)]
+    sign, degrees, minutes = decimalToDM(values, decimals)
+    return [np.where(nan, "", toHemisphere(sign, axis)), formatNumbers(degrees), formatNumbers(minutes, decimals)]
+
+
+def writeRows(out, columns, rows=None):
+
+    """Write string columns as CSV lines, appended to the rows
+    (a list of strings without end of line) if given."""
+
+    columns = [col.tolist() for col in columns]
+    if rows is not None:
+        columns.insert(0, rows)
+    out.write("\n".join(map(",".join, zip(*columns))) + "\n")
+
+
+def openOutput(outputFile):
+
+    """Context manager writing to outputFile, or to stdout if None."""
+
+    return open(outputFile, "w") if outputFile else contextlib.nullcontext(sys.stdout)
+
+
+def readCsvChunks(fd, chunkSize=DEFAULT_CHUNK_SIZE):
+
+    """Yield the lines of a CSV stream (after the header, already
+    read) in lists of at most chunkSize."""
+
+    while True:
+        lines = list(itertools.islice(fd, chunkSize))
+        if not lines:
+            return
+        yield lines
+
+
+def convertCsv(inputFile, outputFile, columns, fmt="dm", decimals=2, reverse=False, chunkSize=DEFAULT_CHUNK_SIZE):
+
+    """Convert CSV columns, chunk by chunk. Columns are given by
+    name or 0-based index. Output rows are the input ones plus
+    the converted columns: NAME_hem, NAME_deg, NAME_min[, NAME_sec]
+    for every column or, with reverse, the decimal NAME for every
+    NAME_* group."""
+
+    with open(inputFile) as fd, openOutput(outputFile) as out:
+
+        header = [h.strip() for h in fd.readline().rstrip("\n").split(",")]
+        def index(name):
+            return int(name) if name.isdigit() else header.index(name)
+
+        # columns to read, and names of the new ones
+        if reverse:
+            groups = []
+            for name in columns:
+                parts = columnNames(name, "dms")
+                groups.append([index(p) if p in header else None for p in parts])
+                if groups[-1][1] is None:
+                    raise ValueError("column %s_deg not found" % name)
+            newNames = list(columns)
+        else:
+            indices = [index(name) for name in columns]
+            newNames = []
+            for name in columns:
+                newNames += columnNames(header[index(name)], fmt)
+        out.write(",".join(header + newNames) + "\n")
+
+        # only the needed columns are parsed, the converted
+        # ones are appended to the input lines
+        if reverse:
+            letters = sorted(set(g[0] for g in groups if g[0] is not None))
+            numbers = sorted(set(i for g in groups for i in g[1:] if i is not None))
+        else:
+            letters, numbers = [], sorted(set(indices))
+        rows = 0
+        for lines in readCsvChunks(fd, chunkSize):
+            values = np.loadtxt(lines, delimiter=",", usecols=numbers, ndmin=2)
+            number = lambda i: values[:, numbers.index(i)] if i is not None else 0
+            if letters:
+                text = np.loadtxt(lines, dtype=str, delimiter=",", usecols=letters, ndmin=2)
+            new = []
+            if reverse:
+                for hem, deg, mins, secs in groups:
+                    sign = fromHemisphere(text[:, letters.index(hem)]) if hem is not None else 1
+                    new.append(formatNumbers(dmsToDecimal(sign, number(deg), number(mins), number(secs)), 6))
+            else:
+                for i in indices:
+                    new += formatColumns(number(i), header[i], fmt, decimals)
+            writeRows(out, new, [line.rstrip("\r\n") for line in lines])
+            rows += len(lines)
+            logger.debug("%s rows converted" % rows)
+    return rows
+
+
+def convertNc(inputFile, variable, outputFile, fmt="dm", decimals=2, chunkSize=DEFAULT_CHUNK_SIZE):
+
+    """Convert a NetCDF variable (a name or a logical name, see
+    nc_reader.NcReader) to DM/DMS CSV columns. Only chunkSize
+    values (rounded to whole rows of the first dimension) are
+    read at once; values are flattened in C order and masked ones
+    become NaN."""
+
+    import nc_reader
+
+    reader = nc_reader.NcReader([inputFile])
+    try:
+        var = reader[variable]
+        rowSize = int(np.prod(var.shape[1:]))
+        step = max(1, chunkSize // max(rowSize, 1))
+        name = reader.resolve(variable)
+        with openOutput(outputFile) as out:
+            out.write(",".join(columnNames(name, fmt)) + "\n")
+            values = 0
+            for start in range(0, var.shape[0] if var.ndim else 1, step):
+                data = var[start:start + step] if var.ndim else var[:]
+                data = np.ma.filled(np.ma.asarray(data, dtype=np.float64), np.nan).ravel()
+                writeRows(out, formatColumns(data, name, fmt, decimals))
+                values += data.size
+                logger.debug("%s values converted" % values)
+    finally:
+        reader.close()
+    return values
+
+
+#############################################################
+#
+# Main
+#
+#############################################################
+
+def convertPair(lat, lon):
+
+    """Print a single lat/lon pair in degrees and minutes."""
+
+    # debug print
+    print("\n=== INPUT DATA ===")
+    print(" - Latitude: %s" % lat)
+    print(" - Longitude: %s" % lon)
+
+    # convert latitude
+    sign, lat_deg, lat_min = decimalToDM(lat)
+    print("\n=== OUTPUT DATA ===")
+    print(" - Output latitude: %d deg %s min %s" % (lat_deg, lat_min, toHemisphere(sign, "lat")))
+
+    # convert longitude
+    sign, lon_deg, lon_min = decimalToDM(lon)
+    print(" - Output longitude: %d deg %s min %s\n" % (lon_deg, lon_min, toHemisphere(sign, "lon")))
+
+
+def main(argv):
+
+    """Command line interface: parse argv (without the program
+    name), convert and return the exit status."""
+
+    inputFile = outputFile = variable = None
+    columns = []
+    fmt = "dm"
+    decimals = 2
+    reverse = False
+    chunkSize = DEFAULT_CHUNK_SIZE
+
+    try:
+        options, rem = getopt.getopt(argv, 'hi:o:c:', ['help', 'inputFile=', 'outputFile=', 'columns=', 'variable=',
+                                                       'format=', 'decimals=', 'reverse', 'chunkSize='])
+        for opt, arg in options:
+            if opt in ('-i', '--inputFile'):
+                inputFile = arg
+            elif opt in ('-o', '--outputFile'):
+                outputFile = arg
+            elif opt in ('-c', '--columns'):
+                columns = arg.split(",")
+            elif opt == '--variable':
+                variable = arg
+            elif opt == '--format':
+                if arg not in ("dm", "dms"):
+                    raise ValueError("format must be dm or dms")
+                fmt = arg
+            elif opt == '--decimals':
+                decimals = int(arg)
+            elif opt == '--reverse':
+                reverse = True
+            elif opt == '--chunkSize':
+                chunkSize = int(arg)
+            elif opt in ('-h', '--help'):
+                printHelp(logger)
+                return 0
+
+        # a single pair
+        if not inputFile:
+            lat, lon = [float(x) for x in rem]
+            convertPair(lat, lon)
+            return 0
+    except (getopt.GetoptError, ValueError):
+        logger.error("wrong arguments!")
+        printHelp(logger)
+        return 1
+
+    try:
+        if inputFile.lower().endswith((".nc", ".nc4")):
+            if not variable:
+                raise ValueError("--variable is required for NetCDF files")
+            convertNc(inputFile, variable, outputFile, fmt, decimals, chunkSize)
+        else:
+            if not columns:
+                raise ValueError("--columns is required for CSV files")
+            convertCsv(inputFile, outputFile, columns, fmt, decimals, reverse, chunkSize)
+    except (ValueError, KeyError, IOError) as e:
+        logger.error("Cannot convert %s: %s" % (inputFile, e))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+
+    # configure logger
+    logging.basicConfig(level=logging.INFO)
 
-# read command line arguments
-lat = float(sys.argv[1])
-lon = float(sys.argv[2])
-
-# debug print
-print("\n=== INPUT DATA ===")
-print(" - Latitude: %s" % lat)
-print(" - Longitude: %s" % lon)
-
-# convert latitude
-lat_deg = int(lat)
-dec_part = lat - int(lat)
-lat_min = round(dec_part * 60, 2)
-print("\n=== OUTPUT DATA ===")
-print(" - Output latitude: %s deg %s min" %(lat_deg, lat_min))
-
-# convert longitude
-lon_deg = int(lon)
-dec_part = lon - int(lon)
-lon_min = round(dec_part * 60, 2)
-print(" - Output longitude: %s deg %s min\n" %(lon_deg, lon_min))
+    sys.exit(main(sys.argv[1:]))
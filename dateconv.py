@@ -1,14 +1,307 @@
 #!/usr/bin/python3
+#
+# This script converts dates between MATLAB datenums (as in the
+# Medslik-II outputs), CF times ("hours since 1950-01-01 00:00",
+# the units written by mdktxt_to_nc.py, or any other "UNIT since
+# DATE") and ISO strings. A single datenum can be given on the
+# command line; whole arrays, NetCDF time variables and columns
+# of text files are converted at once with NumPy datetime64
+# arithmetic.
+#
 
-# reqs
+
+#############################################################
+#
+# requirements
+#
+#############################################################
+
+# global reqs
+import re
 import sys
-from datetime import datetime, timedelta
+import getopt
+import logging
+import itertools
+import contextlib
+import numpy as np
+
+# MATLAB datenum of 1970-01-01: datenum counts days from year 0,
+# 366 days (the leap year 0) before the Python ordinals
+DATENUM_EPOCH = 719529
+
+# default CF units
+CF_UNITS = "hours since 1950-01-01 00:00"
+
+# resolution of the converted times
+TIME_RESOLUTION = "ms"
+
+# CF time units, in milliseconds
+UNIT_MS = {"days": 86400000, "day": 86400000, "d": 86400000,
+           "hours": 3600000, "hour": 3600000, "hrs": 3600000, "hr": 3600000, "h": 3600000,
+           "minutes": 60000, "minute": 60000, "mins": 60000, "min": 60000,
+           "seconds": 1000, "second": 1000, "secs": 1000, "sec": 1000, "s": 1000,
+           "milliseconds": 1, "millisecond": 1, "msec": 1, "ms": 1}
+
+# fields of whitespace separated lines: ISO dates with their time
+# (separated by a space or T), or anything else without spaces
+ISO_FIELD = re.compile(r"\d{4}-\d{2}-\d{2}(?:[ T]\d{1,2}:\d{2}(?::\d{2}(?:\.\d+)?)?)?|\S+")
+
+# logger
+logger = logging.getLogger('dateconv')
+
+
+#############################################################
+#
+# printHelp
+#
+#############################################################
+
+def printHelp(logger):
+
+    logger.info("  This script converts dates between MATLAB datenums, CF times and ISO strings.")
+    logger.info("  Usage: dateconv.py DATENUM, or:")
+    logger.info("  --inputFile=<FILE> (a text file, or a .nc file)")
+    logger.info("  --column=<INDEX> (0-based column of the text file, default: 0)")
+    logger.info("  --skipRows=<N> (header rows of the text file, default: 0)")
+    logger.info("  --variable=<NAME> (NetCDF time variable, default: the time coordinate)")
+    logger.info("  --from=<datenum|cf|iso> (default: cf for NetCDF files, datenum otherwise)")
+    logger.info("  --to=<datenum|cf|iso> (default: iso)")
+    logger.info("  --units=<UNITS> (CF units of the input, default: those of the NetCDF variable, or %s)" % CF_UNITS)
+    logger.info("  --toUnits=<UNITS> (CF units of the output, default: %s)" % CF_UNITS)
+    logger.info("  --outputFile=<FILE> (default: print the results)")
+
+
+#############################################################
+#
+# Conversions
+#
+#############################################################
+
+def parseUnits(units=CF_UNITS):
+
+    """Split CF time units ("UNIT since DATE") into the length of
+    UNIT in milliseconds and the reference date as datetime64.
+    Raises ValueError for units that cannot be parsed."""
+
+    match = re.match(r"^\s*(\w+)\s+since\s+(.+?)\s*$", units)
+    if (not match) or (match.group(1).lower() not in UNIT_MS):
+        raise ValueError("unsupported time units %s" % units)
+    ref = re.sub(r"(\s*UTC|\s*Z|\s*[+-]0+:?0*)$", "", match.group(2)).replace(" ", "T", 1)
+    return UNIT_MS[match.group(1).lower()], np.datetime64(ref, TIME_RESOLUTION)
+
+
+def msToDatetime64(ms, ref):
+
+    """ref plus an array of (float) milliseconds, NaN giving NaT."""
+
+    ms = np.asarray(ms, dtype=np.float64)
+    nan = np.isnan(ms)
+    delta = np.round(np.where(nan, 0, ms)).astype(np.int64).astype("timedelta64[%s]" % TIME_RESOLUTION)
+    return np.where(nan, np.datetime64("NaT"), ref + delta).astype("datetime64[%s]" % TIME_RESOLUTION)
+
+
+def datetime64ToMs(times, ref):
+
+    """Milliseconds from ref of an array of datetime64 (NaN for
+    NaT)."""
+
+    times = np.asarray(times, dtype="datetime64[%s]" % TIME_RESOLUTION)
+    ms = (times - ref).astype("timedelta64[ms]").astype(np.float64)
+    return np.where(np.isnat(times), np.nan, ms)
+
+
+def datenumToDatetime64(values):
+
+    """Convert MATLAB datenums (days from 0000-01-00) to datetime64."""
+
+    return msToDatetime64((np.asarray(values, dtype=np.float64) - DATENUM_EPOCH) * 86400000,
+                          np.datetime64("1970-01-01", TIME_RESOLUTION))
+
+
+def datetime64ToDatenum(times):
+
+    """Convert datetime64 to MATLAB datenums."""
+
+    return datetime64ToMs(times, np.datetime64("1970-01-01", TIME_RESOLUTION)) / 86400000 + DATENUM_EPOCH
+
+
+def cfToDatetime64(values, units=CF_UNITS):
+
+    """Convert CF times in the given units to datetime64 (only the
+    standard, i.e. proleptic Gregorian, calendar is supported)."""
+
+    unit, ref = parseUnits(units)
+    return msToDatetime64(np.asarray(values, dtype=np.float64) * unit, ref)
+
+
+def datetime64ToCf(times, units=CF_UNITS):
+
+    """Convert datetime64 to CF times in the given units."""
+
+    unit, ref = parseUnits(units)
+    return datetime64ToMs(times, ref) / unit
+
+
+def isoToDatetime64(strings):
+
+    """Parse ISO date/time strings (YYYY-MM-DD[THH:MM[:SS]])."""
+
+    return np.asarray(strings, dtype="datetime64[%s]" % TIME_RESOLUTION)
+
+
+def datetime64ToIso(times, unit="s"):
+
+    """Format datetime64 as ISO strings, down to unit."""
+
+    return np.datetime_as_string(np.asarray(times, dtype="datetime64[%s]" % TIME_RESOLUTION), unit=unit)
+
+
+def convertTimes(values, source="datenum", target="iso", units=CF_UNITS, targetUnits=None):
+
+    """Convert an array of times between datenum, cf and iso, with
+    no Python loop per value. units are those of cf inputs,
+    targetUnits those of cf outputs (default: units)."""
+
+    decode = {"datenum": datenumToDatetime64, "iso": isoToDatetime64,
+              "cf": lambda v: cfToDatetime64(v, units)}
+    encode = {"datenum": datetime64ToDatenum, "iso": datetime64ToIso,
+              "cf": lambda t: datetime64ToCf(t, targetUnits or units)}
+    if (source not in decode) or (target not in encode):
+        raise ValueError("unknown time format %s" % (source if source not in decode else target))
+    return encode[target](decode[source](values))
+
+
+#############################################################
+#
+# Inputs
+#
+#############################################################
+
+def readNcTimes(inputFile, variable="time"):
+
+    """Read a NetCDF time variable (a name or a logical name, see
+    nc_reader.NcReader). Returns the (values, units, calendar)
+    tuple; units and calendar are None if not set."""
+
+    import nc_reader
+
+    reader = nc_reader.NcReader([inputFile])
+    try:
+        var = reader[variable]
+        attrs = var.ncattrs()
+        values = np.ma.filled(np.ma.asarray(var[:], dtype=np.float64), np.nan).ravel()
+        units = var.getncattr("units") if "units" in attrs else None
+        calendar = var.getncattr("calendar") if "calendar" in attrs else None
+    finally:
+        reader.close()
+    return values, units, calendar
+
+
+def readTextTimes(inputFile, column=0, skipRows=0, source="datenum"):
+
+    """Read a column of a (whitespace or comma separated) text
+    file, as strings for iso and as numbers otherwise. In
+    whitespace separated files, ISO dates followed by a time
+    ("2019-08-05 20:00", as given to mdktxt_to_nc.py --time) are
+    a single field."""
+
+    with open(inputFile) as fd:
+        for n in range(skipRows):
+            fd.readline()
+        sample = fd.readline()
+        fd.seek(0)
+        delimiter = "," if "," in sample else None
+        if source != "iso":
+            return np.loadtxt(fd, dtype=np.float64, usecols=column, ndmin=1,
+                              skiprows=skipRows, delimiter=delimiter)
+
+        lines = [line for line in itertools.islice(fd, skipRows, None) if line.strip()]
+    try:
+        if delimiter:
+            fields = [line.split(delimiter)[column] for line in lines]
+        else:
+            fields = [ISO_FIELD.findall(line)[column] for line in lines]
+    except IndexError:
+        raise ValueError("column %s not found" % column)
+    return np.char.strip(np.asarray(fields, dtype=str))
+
+
+#############################################################
+#
+# Main
+#
+#############################################################
+
+def main(argv):
+
+    """Command line interface: parse argv (without the program
+    name), convert and return the exit status."""
+
+    inputFile = outputFile = variable = units = source = None
+    targetUnits = CF_UNITS
+    target = "iso"
+    column = skipRows = 0
+
+    try:
+        options, rem = getopt.getopt(argv, 'hi:o:c:', ['help', 'inputFile=', 'outputFile=', 'column=', 'skipRows=',
+                                                       'variable=', 'from=', 'to=', 'units=', 'toUnits='])
+        for opt, arg in options:
+            if opt in ('-i', '--inputFile'):
+                inputFile = arg
+            elif opt in ('-o', '--outputFile'):
+                outputFile = arg
+            elif opt in ('-c', '--column'):
+                column = int(arg)
+            elif opt == '--skipRows':
+                skipRows = int(arg)
+            elif opt == '--variable':
+                variable = arg
+            elif opt == '--from':
+                source = arg
+            elif opt == '--to':
+                target = arg
+            elif opt == '--units':
+                units = arg
+            elif opt == '--toUnits':
+                targetUnits = arg
+            elif opt in ('-h', '--help'):
+                printHelp(logger)
+                return 0
+
+        # a single datenum
+        if not inputFile:
+            d = float(rem[0])
+            converted = datenumToDatetime64(d).item()
+            print(converted.strftime("%A, %d. %B %Y %I:%M%p"))
+            return 0
+    except (getopt.GetoptError, ValueError, IndexError):
+        logger.error("wrong arguments!")
+        printHelp(logger)
+        return 1
+
+    try:
+        if inputFile.lower().endswith((".nc", ".nc4")):
+            values, ncUnits, calendar = readNcTimes(inputFile, variable or "time")
+            if calendar and calendar.lower() not in ("standard", "gregorian", "proleptic_gregorian"):
+                raise ValueError("unsupported calendar %s" % calendar)
+            source = source or "cf"
+            units = units or ncUnits
+        else:
+            source = source or "datenum"
+            values = readTextTimes(inputFile, column, skipRows, source)
+        result = convertTimes(values, source, target, units or CF_UNITS, targetUnits)
+    except (ValueError, KeyError, IOError) as e:
+        logger.error("Cannot convert %s: %s" % (inputFile, e))
+        return 1
+
+    with (open(outputFile, "w") if outputFile else contextlib.nullcontext(sys.stdout)) as out:
+        out.write("\n".join(result.astype(str).tolist()) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
 
-# read input
-d = float(sys.argv[1])
-int_part = int(d)
-dec_part = float(d)-int(d)
+    # configure logger
+    logging.basicConfig(level=logging.INFO)
 
-# produce and print result
-converted = datetime.fromordinal(int_part) + timedelta(dec_part%1)
-print(converted.strftime("%A, %d. %B %Y %I:%M%p"))
+    sys.exit(main(sys.argv[1:]))
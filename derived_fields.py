@@ -0,0 +1,321 @@
+#!/usr/bin/python3
+#
+# This module computes fields derived from a U/V pair (currents
+# or winds): speed, direction and relative vorticity. They are
+# computed with NumPy, a block of time steps at a time, either
+# on gridded arrays (e.g. when mdktxt_to_nc.py writes them) or
+# lazily, on the slices read by the visualisers through
+# nc_reader.NcReader. Lazy results are cached by (files,
+# variables, slice), in memory and optionally on disk.
+#
+
+
+#############################################################
+#
+# requirements
+#
+#############################################################
+
+import os
+import glob
+import logging
+import hashlib
+import warnings
+import collections
+import numpy as np
+
+# Earth radius (m)
+EARTH_RADIUS = 6371000.0
+
+# time steps computed at once
+CHUNK_STEPS = 8
+
+# slices kept in memory, the directory where they are saved
+# (None to keep them in memory only) and its size limit (MB)
+CACHE_ENTRIES = 32
+cacheDir = None
+cacheSize = 256
+derivedCache = collections.OrderedDict()
+
+# CF attributes of the derived fields, for currents and winds
+ATTRIBUTES = {
+    "speed": {"currents": {"standard_name": "sea_water_speed", "long_name": "current speed", "units": "m s-1"},
+              "winds": {"standard_name": "wind_speed", "long_name": "wind speed", "units": "m s-1"}},
+    "direction": {"currents": {"standard_name": "direction_of_sea_water_velocity",
+                               "long_name": "current direction (towards, clockwise from north)", "units": "degree"},
+                  "winds": {"standard_name": "wind_from_direction",
+                            "long_name": "wind direction (from, clockwise from north)", "units": "degree"}},
+    "vorticity": {"currents": {"standard_name": "ocean_relative_vorticity", "long_name": "current relative vorticity", "units": "s-1"},
+                  "winds": {"standard_name": "atmosphere_relative_vorticity", "long_name": "wind relative vorticity", "units": "s-1"}},
+}
+
+# logger
+logger = logging.getLogger('derived_fields')
+
+
+#############################################################
+#
+# Fields
+#
+#############################################################
+
+def speed(u, v):
+
+    """Magnitude of the (u, v) vectors."""
+
+    return np.ma.sqrt(u * u + v * v)
+
+
+def direction(u, v, kind="currents"):
+
+    """Direction of the (u, v) vectors in degrees clockwise from
+    north: where currents go to, where winds come from (the
+    oceanographic and meteorological conventions)."""
+
+    angle = np.degrees(np.ma.arctan2(u, v))
+    if kind == "winds":
+        angle = angle + 180.0
+    return np.ma.mod(angle, 360.0)
+
+
+def vorticity(u, v, lats, lons):
+
+    """Relative vorticity (dv/dx - du/dy, s-1) of (u, v) fields on
+    a regular lat/lon grid (the last two dimensions), in
+    spherical coordinates:
+
+        1 / (R cos(lat)) * (dv/dlon - d(u cos(lat))/dlat)
+
+    Masked or NaN values spread to their neighbours."""
+
+    u = np.ma.filled(np.ma.asarray(u, dtype=np.float64), np.nan)
+    v = np.ma.filled(np.ma.asarray(v, dtype=np.float64), np.nan)
+    if (len(lats) < 2) or (len(lons) < 2):
+        return np.ma.masked_all(u.shape)
+    phi = np.radians(np.asarray(lats, dtype=np.float64))
+    lam = np.radians(np.asarray(lons, dtype=np.float64))
+    cos = np.cos(phi)[:, np.newaxis]
+    dv = np.gradient(v, lam, axis=-1)
+    du = np.gradient(u * cos, phi, axis=-2)
+    return np.ma.masked_invalid((dv - du) / (EARTH_RADIUS * cos))
+
+
+def compute(name, u, v, lats=None, lons=None, kind="currents"):
+
+    """Compute the derived field name (speed, direction or
+    vorticity) from u and v arrays of the same shape, a block of
+    CHUNK_STEPS along the first dimension at a time when they
+    have more than two. lats and lons are the axes of the last
+    two dimensions, needed by vorticity."""
+
+    if not (name in ATTRIBUTES):
+        raise KeyError(name)
+    if (name == "vorticity") and (lats is None or lons is None):
+        raise ValueError("vorticity needs the lat/lon axes")
+
+    def block(u, v):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            if name == "speed":
+                return speed(u, v)
+            elif name == "direction":
+                return direction(u, v, kind)
+            return vorticity(u, v, lats, lons)
+
+    u, v = np.ma.asarray(u), np.ma.asarray(v)
+    if (u.ndim <= 2) or (len(u) <= CHUNK_STEPS):
+        return np.ma.asarray(block(u, v), dtype=np.float32)
+    result = np.ma.empty(u.shape, dtype=np.float32)
+    for start in range(0, len(u), CHUNK_STEPS):
+        result[start:start + CHUNK_STEPS] = block(u[start:start + CHUNK_STEPS], v[start:start + CHUNK_STEPS])
+    return result
+
+
+def getKind(attrs):
+
+    """winds or currents, according to the standard_name or
+    long_name attributes of the U component."""
+
+    text = " ".join(str(attrs.get(a, "")) for a in ("standard_name", "long_name")).lower()
+    return "winds" if "wind" in text else "currents"
+
+
+#############################################################
+#
+# Cache
+#
+#############################################################
+
+def cacheFile(key):
+
+    """Path of the file of a cache key, a (sources, state, slice)
+    tuple of strings: the source paths, their size/mtime, and the
+    variables and slice. Files of the same sources share the
+    hash prefix of sources, so that stale ones can be found."""
+
+    digest = lambda value: hashlib.sha1(value.encode()).hexdigest()[:20]
+    return os.path.join(cacheDir, "derived_%s-%s-%s.npz" % tuple(digest(k) for k in key))
+
+
+def cacheGet(key):
+
+    """A cached slice, from memory or from cacheDir (None if not
+    found)."""
+
+    if key in derivedCache:
+        derivedCache.move_to_end(key)
+        return derivedCache[key]
+    if cacheDir:
+        path = cacheFile(key)
+        try:
+            with np.load(path) as npz:
+                data = np.ma.masked_array(npz["data"], mask=npz["mask"])
+            # the mtime of a file is its last use
+            os.utime(path)
+            logger.debug("Derived field loaded from %s" % path)
+            cachePut(key, data, save=False)
+            return data
+        except (OSError, KeyError, ValueError):
+            pass
+    return None
+
+
+def cachePut(key, data, save=True):
+
+    """Store a slice in memory (dropping the least recently used
+    ones beyond CACHE_ENTRIES) and, if cacheDir is set, on disk,
+    removing the files of older versions of the same sources and
+    the least recently used ones beyond cacheSize MB."""
+
+    derivedCache[key] = data
+    derivedCache.move_to_end(key)
+    while len(derivedCache) > CACHE_ENTRIES:
+        derivedCache.popitem(last=False)
+    if not (save and cacheDir):
+        return
+
+    os.makedirs(cacheDir, exist_ok=True)
+    path = cacheFile(key)
+    tmpFile = "%s.%s.tmp" % (path, os.getpid())
+    with open(tmpFile, "wb") as fd:
+        np.savez(fd, data=np.ma.getdata(data), mask=np.ma.getmaskarray(data))
+    os.replace(tmpFile, path)
+
+    # the sources changed: older slices are stale
+    sources, state = os.path.basename(path).split("-")[:2]
+    for stale in glob.glob(os.path.join(cacheDir, sources + "-*.npz")):
+        if os.path.basename(stale).split("-")[1] != state:
+            logger.debug("Removing stale %s" % stale)
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+
+    evict()
+
+
+def evict():
+
+    """Remove the least recently used slices of cacheDir until
+    they are within cacheSize MB (other files in the directory,
+    e.g. the Basemaps of map_visualiser.py, are not counted).
+    Returns the number of removed files."""
+
+    entries = []
+    for path in glob.glob(os.path.join(cacheDir, "derived_*.npz")):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for mtime, size, path in entries)
+
+    removed = 0
+    for mtime, size, path in sorted(entries):
+        if total <= cacheSize * 1024 * 1024:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    if removed:
+        logger.debug("Evicted %s derived fields from %s" % (removed, cacheDir))
+    return removed
+
+
+#############################################################
+#
+# Lazy variables
+#
+#############################################################
+
+class DerivedVariable:
+
+    """A derived field of the U/V variables of a reader (see
+    nc_reader.NcReader), seen as a read-only variable: indexing
+    reads the same slice of U and V and computes the field on
+    it. Results are cached by (files, variables, slice); the
+    files are identified by path, size and mtime, so that a
+    changed file is never served from the cache."""
+
+    def __init__(self, reader, name, uVar="u", vVar="v"):
+
+        if not (name in ATTRIBUTES):
+            raise KeyError(name)
+        self.reader = reader
+        self.name = name
+        self.u = reader[uVar]
+        self.v = reader[vVar]
+        self.dimensions = self.u.dimensions
+        self.shape = self.u.shape
+        self.ndim = self.u.ndim
+        self.dtype = np.dtype(np.float32)
+        attrs = {a: self.u.getncattr(a) for a in self.u.ncattrs()}
+        self.kind = getKind(attrs)
+        self.attributes = ATTRIBUTES[name][self.kind]
+        self.sources = ";".join(os.path.abspath(f) for f in reader.files)
+        self.state = ";".join("%s:%s" % (os.path.getsize(f), os.path.getmtime(f)) for f in reader.files)
+        self.variables = "%s;%s" % (reader.resolve(uVar), reader.resolve(vVar))
+
+    def ncattrs(self):
+        return list(self.attributes)
+
+    def getncattr(self, attr):
+        return self.attributes[attr]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return self.derive(key)
+
+    def derive(self, key, u=None, v=None):
+
+        """The field on the key slice; u and v are the slice of
+        the components, when already read by the caller."""
+
+        key = key if isinstance(key, tuple) else (key,)
+        key = key + (slice(None),) * (self.ndim - len(key))
+        cacheKey = None
+        if all(isinstance(k, (int, np.integer, slice)) for k in key):
+            cacheKey = (self.sources, self.state, "%s;%s;%s" % (self.variables, self.name, key))
+            data = cacheGet(cacheKey)
+            if data is not None:
+                return data
+
+        # the lat/lon axes of the slice, for vorticity
+        lats = lons = None
+        if self.name == "vorticity":
+            if not (isinstance(key[-2], slice) and isinstance(key[-1], slice)):
+                raise ValueError("vorticity needs 2-D lat/lon slices")
+            lats = self.reader.coordinate("lat")[key[-2]]
+            lons = self.reader.coordinate("lon")[key[-1]]
+
+        if u is None:
+            u, v = self.u[key], self.v[key]
+        data = compute(self.name, u, v, lats, lons, self.kind)
+        if cacheKey:
+            cachePut(cacheKey, data)
+        return data
@@ -6,14 +6,33 @@
 #
 #############################################################
 
-import pdb
+import os
 import sys
+import pickle
+import hashlib
 import getopt
 import logging
+import warnings
 import numpy as np
-from netCDF4 import Dataset
-import matplotlib.pyplot as plt
-from mpl_toolkits.basemap import Basemap, cm
+
+# local reqs (matplotlib, Basemap and nc_reader are imported
+# where needed, so that cached renderings are served quickly)
+import derived_fields
+import render_cache
+
+# logger
+logger = logging.getLogger('map_visualiser')
+
+# Basemaps built by getBasemap and the directory where
+# they are pickled (None to keep them in memory only)
+basemapCache = {}
+basemapCacheDir = None
+
+# level of detail of the plotted fields (see readDecimated)
+lodMethod = "mean"
+
+# number of arrows drawn along the longest side of a map
+QUIVER_ARROWS = 40
 
 
 #############################################################
@@ -26,34 +45,198 @@ def showHelp(logger):
 
     logger.info("  This script plots the area of a NetCDF file.")
     logger.info("  Parameters are:")
-    logger.info("  --inputFile=<FILE>")
+    logger.info("  --inputFile=<FILE[,FILE...]> (file names or glob patterns of a time-split series)")
     logger.info("  --function=<boundaries|winds|currents|temperature>")
-    logger.info("  --latVariable=<LATVAR>")
-    logger.info("  --lonVariable=<LONVAR>")
-    logger.info("  --plotVariable=<PLOTVAR>")
+    logger.info("  --text (print the boundaries as LATMIN,LATMAX,LONMIN,LONMAX instead of plotting them)")
+    logger.info("  --latVariable=<LATVAR> (default: detected from the CF attributes)")
+    logger.info("  --lonVariable=<LONVAR> (default: detected from the CF attributes)")
+    logger.info("  --plotVariable=<PLOTVAR> (a variable name, u, v, or speed, direction, vorticity derived from u/v)")
+    logger.info("  --cacheDir=<DIR> (where projections are cached between runs)")
+    logger.info("  --lod=<mean|stride|off> (how fields are reduced to the figure resolution, default: mean)")
+    logger.info("  --bbox=<LATMIN,LATMAX,LONMIN,LONMAX> (region to plot, default: the whole domain)")
+    logger.info("  --time=<INDEX> (time step to plot, default: 0)")
+    logger.info("  --level=<INDEX> (depth level to plot, default: 0)")
+    logger.info("  --outputFile=<FILE> (save the plot without GUI, e.g. to a .png, instead of showing it)")
+    logger.info("  --renderCache=<DIR> (serve the --outputFile of already rendered plots from DIR)")
+    logger.info("  --renderCacheSize=<MB> (size limit of the render cache, default: %s)" % render_cache.DEFAULT_CACHE_SIZE)
     
 
 #############################################################
 #
-# Get Boundaries
+# Basemap cache
 #
 #############################################################
 
-def getBoundaries(ds):
-    
-    # get coordinates
+def getBasemap(latMin, latMax, lonMin, lonMax, projection='merc', resolution='l'):
+
+    """Get the Basemap for a domain. Building a Basemap means
+    clipping and projecting the coastline geometry, so instances
+    are kept in memory keyed by (projection, bounds, resolution)
+    and, if basemapCacheDir is set, pickled to disk to be reused
+    by later runs."""
+
+    key = (projection, round(latMin, 6), round(latMax, 6), round(lonMin, 6), round(lonMax, 6), resolution)
+    if key in basemapCache:
+        return basemapCache[key]
+
+    # look for it on disk
+    m = cacheFile = None
+    if basemapCacheDir:
+        cacheFile = os.path.join(basemapCacheDir, "basemap_%s.pickle" % hashlib.sha1(repr(key).encode()).hexdigest())
+        try:
+            with open(cacheFile, "rb") as fd:
+                m = pickle.load(fd)
+            logger.debug("Basemap loaded from %s" % cacheFile)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            m = None
+
+    # build it
+    if not m:
+        from mpl_toolkits.basemap import Basemap
+        m = Basemap(projection=projection,
+                    llcrnrlat=latMin, urcrnrlat=latMax,
+                    llcrnrlon=lonMin, urcrnrlon=lonMax,
+                    resolution=resolution)
+        if cacheFile:
+            os.makedirs(basemapCacheDir, exist_ok=True)
+            with open(cacheFile + ".tmp", "wb") as fd:
+                pickle.dump(m, fd, pickle.HIGHEST_PROTOCOL)
+            os.replace(cacheFile + ".tmp", cacheFile)
+
+    basemapCache[key] = m
+    return m
+
+
+def drawBackground(m):
+
+    """Draw coastlines, states, countries and continents of a
+    Basemap on the current axes."""
+
+    # add coastlines, states, and country boundaries
+    m.drawcoastlines()
+    m.drawstates()
+    m.drawcountries()
+
+    # add color
+    m.fillcontinents(color='coral',lake_color='aqua')
+
+
+#############################################################
+#
+# Level of detail
+#
+#############################################################
+
+def getDecimation(shape, budget=None):
+
+    """Block size (ky, kx) bringing a 2-D field of the given shape
+    down to at most budget (rows, columns) cells; the default
+    budget is the pixels of the current figure, since finer
+    detail cannot be seen anyway."""
+
+    if budget is None:
+        import matplotlib.pyplot as plt
+        fig = plt.gcf()
+        width, height = fig.get_size_inches() * fig.dpi
+        budget = (height, width)
+    return (max(1, int(np.ceil(shape[0] / float(budget[0])))),
+            max(1, int(np.ceil(shape[1] / float(budget[1])))))
+
+
+def blockAverage(arr, *factors):
+
+    """Average an array (1-D with one factor, 2-D with two) over
+    blocks of the given size, ignoring masked and NaN values. The
+    array is padded at the end when its size is not a multiple of
+    the block size. Averaging the U and V fields separately gives
+    the vector average of the arrows."""
+
+    if all(k == 1 for k in factors):
+        return arr
+
+    data = np.ma.filled(np.ma.asarray(arr, dtype=np.float64), np.nan)
+    data = np.pad(data, [(0, -n % k) for n, k in zip(data.shape, factors)], constant_values=np.nan)
+    blocks = []
+    for n, k in zip(data.shape, factors):
+        blocks += [n // k, k]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        mean = np.nanmean(data.reshape(blocks), axis=tuple(range(1, 2 * len(factors), 2)))
+    return np.ma.masked_invalid(mean)
+
+
+def readDecimated(var, lead, lats, lons, ky, kx, region=None):
+
+    """Read the 2-D field var[lead + (lat, lon)], restricted to the
+    (latSlice, lonSlice) region (see getRegion), reduced by
+    ky x kx according to lodMethod: "mean" block-averages the
+    field, "stride" reads only every ky-th row and kx-th column
+    from disk, "off" reads the full field. lats and lons are the
+    full 1-D axes.
+
+    Returns the (field, lats, lons) tuple."""
+
+    latSlice, lonSlice = region or (slice(None), slice(None))
+    lats, lons = lats[latSlice], lons[lonSlice]
+    if lodMethod == "stride":
+        return (var[lead + (slice(latSlice.start, latSlice.stop, ky), slice(lonSlice.start, lonSlice.stop, kx))],
+                lats[::ky], lons[::kx])
+    data = var[lead + (latSlice, lonSlice)]
+    if lodMethod == "off":
+        return data, lats, lons
+    return blockAverage(data, ky, kx), blockAverage(lats, ky), blockAverage(lons, kx)
+
+
+#############################################################
+#
+# Spatial subsetting
+#
+#############################################################
+
+def getRangeSlice(arr, vmin, vmax):
+
+    """Slice of the values of a monotonic (increasing or
+    decreasing) 1-D axis falling in [vmin, vmax], found by binary
+    search."""
+
+    arr = np.asarray(arr)
+    if arr[0] <= arr[-1]:
+        return slice(int(np.searchsorted(arr, vmin, "left")), int(np.searchsorted(arr, vmax, "right")))
+    n = len(arr)
+    rev = arr[::-1]
+    return slice(n - int(np.searchsorted(rev, vmax, "right")), n - int(np.searchsorted(rev, vmin, "left")))
+
+
+def getRegion(lats, lons, bbox=None):
+
+    """(latSlice, lonSlice) index ranges of the (latMin, latMax,
+    lonMin, lonMax) bbox on the 1-D lat/lon axes, so that only the
+    region of interest is read from disk (the whole domain if bbox
+    is None)."""
+
+    if not bbox:
+        return slice(0, len(lats)), slice(0, len(lons))
+    region = getRangeSlice(lats, bbox[0], bbox[1]), getRangeSlice(lons, bbox[2], bbox[3])
+    if any(sl.stop <= sl.start for sl in region):
+        logger.error("The bounding box %s does not contain any grid point!" % (bbox,))
+        sys.exit(1)
+    logger.debug("Reading rows %s:%s and columns %s:%s" % (region[0].start, region[0].stop, region[1].start, region[1].stop))
+    return region
+
+
+def getMapBounds(reader, bbox=None):
+
+    """Bounds of the map: the ones of the files of a reader (see
+    NcReader.getBoundaries), restricted to bbox if given."""
+
     try:
-        latMin = ds.variables[latVar][:].data.min()
-        latMax = ds.variables[latVar][:].data.max()
-        lonMin = ds.variables[lonVar][:].data.min()
-        lonMax = ds.variables[lonVar][:].data.max()
+        latMin, latMax, lonMin, lonMax = reader.getBoundaries()
     except KeyError:
         logger.error("Check your variables!")
         sys.exit(1)
-    logger.debug("Latitude bounds are %s and %s" % (latMin, latMax))
-    logger.debug("Longitude bounds are %s and %s" % (lonMin, lonMax))
-
-    # return
+    if bbox:
+        latMin, latMax = max(latMin, bbox[0]), min(latMax, bbox[1])
+        lonMin, lonMax = max(lonMin, bbox[2]), min(lonMax, bbox[3])
     return latMin, latMax, lonMin, lonMax
 
 
@@ -63,118 +246,115 @@ def getBoundaries(ds):
 #
 #############################################################
 
-def plotBoundaries(ds, inputFile):
+def plotBoundaries(reader, title, bbox=None, outputFile=None):
+
+    import matplotlib.pyplot as plt
 
     # get boundaries
-    latMin, latMax, lonMin, lonMax = getBoundaries(ds)
+    latMin, latMax, lonMin, lonMax = getMapBounds(reader, bbox)
     
     # plot them
-    m = Basemap(projection='merc',
-                llcrnrlat=latMin, urcrnrlat=latMax,
-                llcrnrlon=lonMin, urcrnrlon=lonMax,                    
-                resolution='l')
-
-    # add coastlines, states, and country boundaries
-    m.drawcoastlines()
-    m.drawstates()
-    m.drawcountries()
-    
-    # add color
-    m.fillcontinents(color='coral',lake_color='aqua')
+    m = getBasemap(latMin, latMax, lonMin, lonMax)
+    drawBackground(m)
 
     # set the title
-    plt.title(inputFile)
+    plt.title(title)
             
     # show the plot
-    plt.show()
+    showPlot(outputFile)
+
+
+def printBoundaries(reader, bbox=None):
+
+    """Print the boundaries of the files (or of the bbox region of
+    them) as LATMIN,LATMAX,LONMIN,LONMAX, the format of --bbox,
+    without loading matplotlib."""
+
+    print(",".join(str(float(b)) for b in getMapBounds(reader, bbox)))
+
+
+def showPlot(outputFile=None):
+
+    """Show the current figure or, with outputFile, save it."""
+
+    import matplotlib.pyplot as plt
+
+    if outputFile:
+        plt.savefig(outputFile)
+        plt.close()
+    else:
+        plt.show()
     
     
 #############################################################
 #
-# Plot Winds
+# Plot Field
 #
 #############################################################
 
-def plotWinds(ds, inputFile, windVar):
+def plotField(reader, title, plotVar, lead, bbox=None, outputFile=None):
+
+    """Plot the 2-D field plotVar[lead + (lat, lon)] of the bbox
+    region over the map background. plotVar is a variable name
+    or a logical name of the reader (see NcReader.resolve), or
+    speed, direction or vorticity, derived from u/v. The plot is
+    shown or, with outputFile, saved (see showPlot)."""
+
+    import matplotlib.pyplot as plt
 
     # get boundaries
-    latMin, latMax, lonMin, lonMax = getBoundaries(ds)
+    latMin, latMax, lonMin, lonMax = getMapBounds(reader, bbox)
     
     # plot them
-    m = Basemap(projection='merc',
-                llcrnrlat=latMin, urcrnrlat=latMax,
-                llcrnrlon=lonMin, urcrnrlon=lonMax,                    
-                resolution='l')
-
-    # Add Coastlines, States, and Country Boundaries
-    m.drawcoastlines()
-    m.drawstates()
-    m.drawcountries()
-
-    # add color
-    m.fillcontinents(color='coral',lake_color='aqua')
+    m = getBasemap(latMin, latMax, lonMin, lonMax)
+    drawBackground(m)
 
     # set the title
-    plt.title(inputFile)
+    plt.title(title)
 
-    # get data for winds
+    # get data of the region, reduced to the detail
+    # that the figure can show
     try:
-        lons = ds.variables[lonVar][:]
-        lats = ds.variables[latVar][:]
-        tmax = ds.variables[windVar][0,:,:]
-    except KeyError:
+        lons = reader.coordinate("lon")
+        lats = reader.coordinate("lat")
+        var = reader[plotVar]
+        region = getRegion(lats, lons, bbox)
+        ky, kx = getDecimation([sl.stop - sl.start for sl in region])
+        tmax, lats, lons = readDecimated(var, lead, lats, lons, ky, kx, region)
+    except (KeyError, IndexError):
         logger.error("Check your variables!")
-        sys.exit(1)        
+        sys.exit(1)
+    except ValueError as e:
+        logger.error(str(e))
+        sys.exit(1)
     lon, lat = np.meshgrid(lons, lats)
     xi, yi = m(lon, lat)
-    cs = m.pcolor(xi, yi, np.squeeze(tmax))
+    cs = m.pcolormesh(xi, yi, np.squeeze(tmax), shading='nearest')
     
     # show the plot
-    plt.show()
+    showPlot(outputFile)
 
 
 #############################################################
 #
-# Plot Currents
+# Plot Winds
 #
 #############################################################
 
-def plotCurrents(ds, inputFile, tempVar):
+def plotWinds(reader, title, windVar, bbox=None, time=0, outputFile=None):
 
-    # get boundaries
-    latMin, latMax, lonMin, lonMax = getBoundaries(ds)
-    
-    # plot them
-    m = Basemap(projection='merc',
-                llcrnrlat=latMin, urcrnrlat=latMax,
-                llcrnrlon=lonMin, urcrnrlon=lonMax,                    
-                resolution='l')
+    plotField(reader, title, windVar, (time,), bbox, outputFile)
 
-    # Add Coastlines, States, and Country Boundaries
-    m.drawcoastlines()
-    m.drawstates()
-    m.drawcountries()
 
-    # add color
-    m.fillcontinents(color='coral',lake_color='aqua')
+#############################################################
+#
+# Plot Currents
+#
+#############################################################
 
-    # set the title
-    plt.title(inputFile)
+def plotCurrents(reader, title, tempVar, bbox=None, time=0, level=0, outputFile=None):
 
-    # get data for winds
-    try:
-        lons = ds.variables[lonVar][:]
-        lats = ds.variables[latVar][:]
-        tmax = ds.variables[tempVar][0,0,:,:]
-    except KeyError:
-        logger.error("Check your variables!")
-        sys.exit(1)        
-    lon, lat = np.meshgrid(lons, lats)
-    xi, yi = m(lon, lat)
-    cs = m.pcolor(xi, yi, np.squeeze(tmax))
-    
-    # show the plot
-    plt.show()
+    plotField(reader, title, tempVar, (time, level), bbox, outputFile)
         
 
 #############################################################
@@ -206,25 +386,53 @@ if __name__ == "__main__":
 
     inputFile = None
     function = None
+    names = {}
+    bbox = None
+    plotVar = outputFile = renderCacheDir = None
+    textOnly = False
+    renderCacheSize = render_cache.DEFAULT_CACHE_SIZE
+    timeIndex = levelIndex = 0
     try:
-        options, rem = getopt.getopt(sys.argv[1:], 'i:hf:p:', ['inputFile=', 'help', 'latVariable=', 'lonVariable=', 'function=', 'plotVariable='])
+        options, rem = getopt.getopt(sys.argv[1:], 'i:hf:p:', ['inputFile=', 'help', 'latVariable=', 'lonVariable=', 'function=', 'plotVariable=', 'cacheDir=', 'lod=',
+                                                              'bbox=', 'time=', 'level=', 'outputFile=', 'renderCache=', 'renderCacheSize=', 'text'])
     
         for opt, arg in options:
             if opt in ('-i', '--inputFile'):
                 inputFile = arg
             elif opt in ('--latVariable'):                
-                latVar = arg
+                names["lat"] = arg
             elif opt in ('--lonVariable'):                
-                lonVar = arg
+                names["lon"] = arg
             elif opt in ('-f', '--function'):
                 function = arg
             elif opt in ('-p', '--plotVariable'):
                 plotVar = arg
+            elif opt == '--cacheDir':
+                basemapCacheDir = arg
+                derived_fields.cacheDir = arg
+            elif opt == '--lod':
+                lodMethod = arg
+            elif opt == '--bbox':
+                bbox = [float(x) for x in arg.split(",")]
+                if len(bbox) != 4:
+                    raise ValueError("bbox must be LATMIN,LATMAX,LONMIN,LONMAX")
+            elif opt == '--time':
+                timeIndex = int(arg)
+            elif opt == '--level':
+                levelIndex = int(arg)
+            elif opt == '--outputFile':
+                outputFile = arg
+            elif opt == '--renderCache':
+                renderCacheDir = arg
+            elif opt == '--renderCacheSize':
+                renderCacheSize = float(arg)
+            elif opt == '--text':
+                textOnly = True
             elif opt in ('-h', '--help'):
                 showHelp(logger)
                 sys.exit(0)
     
-    except getopt.GetoptError:
+    except (getopt.GetoptError, ValueError):
         showHelp(logger)
         sys.exit(1)
 
@@ -240,16 +448,39 @@ if __name__ == "__main__":
     #
     #############################################################
 
-    # open netCDF file
-    ds = Dataset(inputFile, "r")
+    # serve plots already rendered, before opening the files
+    # or loading matplotlib
+    if renderCacheDir and (textOnly or not outputFile):
+        logger.warning("--renderCache is only used with --outputFile, not with --text")
+        renderCacheDir = None
+    params = {"function": function, "plotVariable": plotVar, "names": names, "bbox": bbox,
+              "time": timeIndex, "level": levelIndex, "lod": lodMethod, "title": inputFile}
+    if renderCacheDir and render_cache.fetch(renderCacheDir, [inputFile], params, outputFile):
+        logger.info("%s served from the render cache" % outputFile)
+        sys.exit(0)
+
+    # non-interactive rendering
+    if outputFile and not textOnly:
+        import matplotlib
+        matplotlib.use("Agg")
+
+    # open netCDF files
+    import nc_reader
+    reader = nc_reader.NcReader(inputFile.split(","), names)
 
     # invoke the proper function
-    if function == "boundaries":
-        plotBoundaries(ds, inputFile)
+    if (function == "boundaries") and textOnly:
+        printBoundaries(reader, bbox)
+    elif function == "boundaries":
+        plotBoundaries(reader, inputFile, bbox, outputFile)
     elif function == "winds":
-        plotWinds(ds, inputFile, plotVar)
+        plotWinds(reader, inputFile, plotVar, bbox, timeIndex, outputFile)
     elif function == "currents":
-        plotCurrents(ds, inputFile, plotVar)
+        plotCurrents(reader, inputFile, plotVar, bbox, timeIndex, levelIndex, outputFile)
     
-    # close file
-    ds.close()
+    # close files
+    reader.close()
+
+    # keep the plot for the next requests
+    if renderCacheDir:
+        render_cache.store(renderCacheDir, [inputFile], params, outputFile, renderCacheSize)
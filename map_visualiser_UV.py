@@ -6,15 +6,41 @@
 #
 #############################################################
 
-import pdb
+import os
 import sys
+import time
+import queue
+import threading
+import shutil
+import tempfile
+import multiprocessing
 import getopt
 import logging
 import numpy as np
-from netCDF4 import Dataset
-import matplotlib.pyplot as plt
-from mpl_toolkits.basemap import Basemap, cm
 import warnings
+import map_visualiser
+import nc_reader
+import nc_inventory
+import derived_fields
+
+# seconds every time step stays on screen
+FRAME_PAUSE = 0.5
+
+# time steps read ahead while rendering (0 to disable)
+PREFETCH_STEPS = 2
+
+# what the sea is coloured by (a variable, or speed, direction or
+# vorticity, derived from U/V)
+DEFAULT_COLOUR = "speed"
+
+# frames per second and resolution of the rendered steps
+FRAME_RATE = 4
+FRAME_DPI = 100
+
+# logger
+logger = logging.getLogger('map_visualiser')
+
+
 
 #############################################################
 #
@@ -26,11 +52,22 @@ def showHelp(logger):
 
     logger.info("  This script plots the area of a NetCDF file.")
     logger.info("  Parameters are:")
-    logger.info("  --inputFile=<FILE>")
-    logger.info("  --function=<boundaries|winds|currents|temperature>")
-    logger.info("  --latVariable=<LATVAR>")
-    logger.info("  --lonVariable=<LONVAR>")
-    logger.info("  --plotVariable=<PLOTVAR>")
+    logger.info("  --inputFiles=<FILE[,FILE...]> (U and V files, or glob patterns of a time-split series)")
+    logger.info("  --function=<boundaries|winds|currents|info>")
+    logger.info("  --text (print the boundaries as LATMIN,LATMAX,LONMIN,LONMAX instead of plotting them)")
+    logger.info("  --latVariable=<LATVAR> (default: detected from the CF attributes)")
+    logger.info("  --lonVariable=<LONVAR> (default: detected from the CF attributes)")
+    logger.info("  --plotVariables=<UVAR,VVAR> (default: detected from the CF attributes)")
+    logger.info("  --cacheDir=<DIR> (where projections are cached between runs)")
+    logger.info("  --lod=<mean|stride|off> (how fields are reduced to the figure resolution, default: mean)")
+    logger.info("  --outputFile=<FILE> (render without GUI to numbered images, e.g. frames/step_%04d.png, or to .mp4/.gif)")
+    logger.info("  --steps=<START:END> (range of time steps to plot, default: all)")
+    logger.info("  --workers=<N> (render the steps of --outputFile with N processes)")
+    logger.info("  --bbox=<LATMIN,LATMAX,LONMIN,LONMAX> (region to plot, default: the whole domain)")
+    logger.info("  --time=<INDEX> (single time step to plot, same as --steps=INDEX:INDEX+1)")
+    logger.info("  --level=<INDEX> (depth level to plot, default: 0)")
+    logger.info("  --prefetch=<N> (time steps read ahead while rendering, 0 disables, default: %s)" % PREFETCH_STEPS)
+    logger.info("  --colour=<speed|direction|vorticity|VAR> (what the sea is coloured by, default: %s)" % DEFAULT_COLOUR)
     
 
 #############################################################
@@ -39,186 +76,438 @@ def showHelp(logger):
 #
 #############################################################
 
-def getInfo(ds):
-
-    #pdb.set_trace()
-    for v in ds.variables:
-        print(v)
+def getInfo(inputFiles):
 
+    """Print the header summary of the input files (see
+    nc_inventory.scanFile); no data is read."""
 
-def getRangeIndexes(arr, var_min, var_max):
-    return np.where((arr >= var_min) & (arr <= var_max))[0]
+    for inputFile in nc_reader.expandInputs(inputFiles):
+        print(nc_inventory.formatRecord(nc_inventory.scanFile(inputFile)))
 
 
 #############################################################
 #
-# Get Boundaries
+# Plot Currents
 #
 #############################################################
 
-def getBoundaries(ds):
-    
-    # get coordinates
+def openFrameWriter(fig, outputFile):
+
+    """Return a (grab, finish) pair of functions saving the frames
+    of fig: .mp4 and .gif files are encoded on the fly as a single
+    animation, any other name is a pattern for numbered images
+    (e.g. frames/currents_%04d.png; the number is appended to the
+    name if it has no %d field)."""
+
+    import matplotlib.animation as animation
+
+    ext = os.path.splitext(outputFile)[1].lower()
+    if ext in (".mp4", ".gif"):
+        if ext == ".mp4":
+            writer = animation.FFMpegWriter(fps=FRAME_RATE)
+        else:
+            writer = animation.PillowWriter(fps=FRAME_RATE)
+        writer.setup(fig, outputFile, dpi=FRAME_DPI)
+        return (lambda t: writer.grab_frame()), writer.finish
+
+    if not ("%" in outputFile):
+        root, ext = os.path.splitext(outputFile)
+        outputFile = root + "_%04d" + (ext or ".png")
+    if os.path.dirname(outputFile):
+        os.makedirs(os.path.dirname(outputFile), exist_ok=True)
+    return (lambda t: fig.savefig(outputFile % t, dpi=FRAME_DPI)), (lambda: None)
+
+
+def getLevelOfDetail(reader, bbox=None):
+
+    """Region of the bbox and how the fields are reduced to the
+    current figure: colours to its pixels, arrows to
+    QUIVER_ARROWS along the longest side.
+
+    Returns the (region, lats, lons, k, kq) tuple: the (latSlice,
+    lonSlice) region, its axes and the colour/arrow decimations."""
+
     try:
-        latMin = ds.variables[latVar][:].data.min()
-        latMax = ds.variables[latVar][:].data.max()
-        lonMin = ds.variables[lonVar][:].data.min()
-        lonMax = ds.variables[lonVar][:].data.max()
+        lons = reader.coordinate("lon")
+        lats = reader.coordinate("lat")
     except KeyError:
         logger.error("Check your variables!")
         sys.exit(1)
-    logger.debug("Latitude bounds are %s and %s" % (latMin, latMax))
-    logger.debug("Longitude bounds are %s and %s" % (lonMin, lonMax))
+    except ValueError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    region = map_visualiser.getRegion(lats, lons, bbox)
+    lats, lons = lats[region[0]], lons[region[1]]
+    shape = (len(lats), len(lons))
+    k = map_visualiser.getDecimation(shape)
+    kq = map_visualiser.getDecimation(shape, budget=[map_visualiser.QUIVER_ARROWS * n / float(max(shape)) for n in shape])
+    if map_visualiser.lodMethod == "off":
+        k = (1, 1)
+    logger.debug("Colours reduced by %s, arrows by %s" % (k, kq))
+    return region, lats, lons, k, kq
+
+
+def getColourVariable(reader, colour, uVar="u", vVar="v"):
+
+    """The variable the sea is coloured by: a field derived from
+    uVar/vVar (see derived_fields.py) or a variable of the reader."""
+
+    if colour in derived_fields.ATTRIBUTES:
+        return reader.derivedField(colour, uVar, vVar)
+    return reader[colour]
+
+
+def getColourLimits(colours):
+
+    """The (vmin, vmax) range of the colours of a step, None if
+    they are all missing."""
+
+    values = np.ma.filled(np.ma.masked_invalid(np.ma.asarray(colours, dtype=np.float64)), np.nan)
+    if np.isnan(values).all():
+        return None
+    return float(np.nanmin(values)), float(np.nanmax(values))
+
+
+def getFirstStepLimits(reader, uVar, vVar, steps, bbox=None, level=0, colour=DEFAULT_COLOUR):
+
+    """The colour range of the first of steps, as plotCurrents
+    draws it (reduced to a figure of the default size), or None."""
+
+    import matplotlib.pyplot as plt
+
+    if not steps:
+        return None
+    fig = plt.figure()
+    region, lats, lons, k, kq = getLevelOfDetail(reader, bbox)
+    plt.close(fig)
+    colours = readCurrents(reader[uVar], reader[vVar], steps[0], k, kq, region, level,
+                           getColourVariable(reader, colour, uVar, vVar))[0]
+    return getColourLimits(colours)
+
+
+def readCurrents(uVar, vVar, t, k, kq, region, level=0, colourVar=None):
+
+    """Read U/V of time step t and depth level (None for fields
+    without depth, e.g. winds) in the (latSlice, lonSlice) region and reduce them for plotting: the
+    colours by k (colourVar, U by default; derived fields, see
+    derived_fields.py, are computed on the U/V just read), U and
+    V by kq for the arrows (block averages of the two components
+    give the vector average of the arrows). Only the region is
+    read from disk and, with the "stride" level of detail, only
+    the needed rows/columns of it.
+
+    Returns the (colours, U arrows, V arrows) tuple."""
+
+    latSlice, lonSlice = region
+    lead = (t,) if level is None else (t, level)
+    colourVar = uVar if colourVar is None else colourVar
+    if map_visualiser.lodMethod == "stride":
+        def strided(f):
+            return (slice(latSlice.start, latSlice.stop, f[0]), slice(lonSlice.start, lonSlice.stop, f[1]))
+        return (colourVar[lead + strided(k)],
+                uVar[lead + strided(kq)],
+                vVar[lead + strided(kq)])
+
+    key = lead + (latSlice, lonSlice)
+    u = uVar[key]
+    v = vVar[key]
+    if colourVar is uVar:
+        colours = u
+    elif isinstance(colourVar, derived_fields.DerivedVariable) and (colourVar.u is uVar) and (colourVar.v is vVar):
+        colours = colourVar.derive(key, u, v)
+    else:
+        colours = colourVar[key]
+    return (map_visualiser.blockAverage(colours, *k),
+            map_visualiser.blockAverage(u, *kq),
+            map_visualiser.blockAverage(v, *kq))
+
+
+def prefetchSteps(read, steps, depth, stats):
+
+    """Yield (t, read(t)) for every t in steps. With depth > 0 a
+    background thread reads up to depth steps ahead through a
+    bounded queue, so that I/O overlaps with the work done by the
+    caller on the current step, while memory stays bounded. The
+    time spent reading and waiting for data is added to the
+    "read" and "wait" keys of stats."""
+
+    # synchronous reads
+    if depth < 1:
+        for t in steps:
+            t0 = time.perf_counter()
+            data = read(t)
+            elapsed = time.perf_counter() - t0
+            stats["read"] += elapsed
+            stats["wait"] += elapsed
+            yield t, data
+        return
+
+    fifo = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                fifo.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def reader():
+        try:
+            for t in steps:
+                t0 = time.perf_counter()
+                data = read(t)
+                stats["read"] += time.perf_counter() - t0
+                if not put((t, data, None)):
+                    return
+        except Exception as e:
+            put((None, None, e))
+        put(None)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            t0 = time.perf_counter()
+            item = fifo.get()
+            stats["wait"] += time.perf_counter() - t0
+            if item is None:
+                break
+            t, data, error = item
+            if error:
+                raise error
+            yield t, data
+    finally:
+        stop.set()
+        thread.join()
+
+
+def plotCurrents(reader, uVar="u", vVar="v", outputFile=None, steps=None, bbox=None, level=0, prefetch=PREFETCH_STEPS,
+                 title="Currents", scale=3, colour=DEFAULT_COLOUR, limits=None):
+
+    """Plot the currents at the given depth level of every time
+    step (or of the steps in the steps range) in the bbox region,
+    colouring the sea by colour (a variable, or a field derived
+    from U/V: speed, direction or vorticity) and drawing U/V
+    arrows (scale as in quiver). uVar and vVar are variable
+    names or logical names of the reader (see NcReader.resolve). Steps are shown
+    on screen or, with outputFile, rendered without a GUI to
+    numbered images or to an animation (see openFrameWriter).
+    The data of the next prefetch steps is read in background
+    (see prefetchSteps). The colour scale is the (vmin, vmax) of
+    limits, or the range of the first step."""
+
+    import matplotlib.pyplot as plt
 
-    # return
-    return latMin, latMax, lonMin, lonMax
+    # get boundaries
+    latMin, latMax, lonMin, lonMax = map_visualiser.getMapBounds(reader, bbox)
+
+    # time steps available in the files
+    try:
+        nSteps = reader[uVar].shape[0]
+    except KeyError:
+        logger.error("Check your variables!")
+        sys.exit(1)
+    steps = range(nSteps)[steps or slice(None)]
+    if not steps:
+        logger.error("No time steps selected!")
+        sys.exit(1)
+    logger.debug("Plotting %s of %s time steps" % (len(steps), nSteps))
+
+    # non-interactive rendering
+    if outputFile:
+        plt.switch_backend("Agg")
+
+    # the projection and the background are built once,
+    # then only the data layer is updated at every step
+    fig = plt.figure()
+    m = map_visualiser.getBasemap(latMin, latMax, lonMin, lonMax, projection='cyl')
+    map_visualiser.drawBackground(m)
+
+    # get coordinates and work out the level of detail
+    region, lats, lons, k, kq = getLevelOfDetail(reader, bbox)
+    if map_visualiser.lodMethod == "stride":
+        latsC, lonsC, X, Y = lats[::k[0]], lons[::k[1]], lons[::kq[1]], lats[::kq[0]]
+    else:
+        latsC, lonsC = map_visualiser.blockAverage(lats, k[0]), map_visualiser.blockAverage(lons, k[1])
+        X, Y = map_visualiser.blockAverage(lons, kq[1]), map_visualiser.blockAverage(lats, kq[0])
+    lon, lat = np.meshgrid(lonsC, latsC)
+    xi, yi = m(lon, lat)
+
+    if outputFile:
+        grab, finish = openFrameWriter(fig, outputFile)
+
+    # the next steps are read in background while the
+    # current one is drawn
+    try:
+        uData = reader[uVar]
+        vData = reader[vVar]
+        cData = getColourVariable(reader, colour, uVar, vVar)
+    except KeyError:
+        logger.error("Check your variables!")
+        sys.exit(1)
+    stats = {"read": 0.0, "wait": 0.0}
+    frames = prefetchSteps(lambda t: readCurrents(uData, vData, t, k, kq, region, level, cData), steps, prefetch, stats)
+
+    cs = q = None
+    start = time.perf_counter()
+    while True:
+    
+        # get data for currents
+        try:
+            t, (umax, UU, VV) = next(frames)
+            print("Reading variables: ok")
+        except StopIteration:
+            break
+        except IndexError:
+            logger.error("Check your variables!")
+            sys.exit(1)
+
+        # set the title
+        plt.title("%s (step %s)" % (title, t))
+
+        # color the sea and draw arrows the first time,
+        # then just update their data
+        if not cs:
+            vmin, vmax = limits or getColourLimits(umax) or (None, None)
+            cs = m.pcolormesh(xi, yi, umax, shading='nearest', vmin=vmin, vmax=vmax)
+            q = m.quiver(X, Y, UU, VV, scale=scale)
+        else:
+            cs.set_array(umax)
+            q.set_UVC(UU, VV)
+
+        # save or show the step
+        if outputFile:
+            grab(t)
+        else:
+            plt.draw()
+            plt.pause(FRAME_PAUSE)
+
+    # report where time went
+    total = time.perf_counter() - start
+    logger.info("%s steps: %.2fs waiting for data, %.2fs rendering (%.2fs of reads)" %
+                (len(steps), stats["wait"], total - stats["wait"], stats["read"]))
+
+    if outputFile:
+        finish()
+        plt.close(fig)
+    else:
+        # keep the last step on screen
+        plt.show()
 
 
 #############################################################
 #
-# Plot Boundaries
+# Plot Winds
 #
 #############################################################
 
-def plotBoundaries(ds, inputFile):
+def plotWinds(reader, uVar="u", vVar="v", outputFile=None, steps=None, bbox=None, prefetch=PREFETCH_STEPS,
+              colour=DEFAULT_COLOUR):
+
+    """Same as plotCurrents, for U/V fields without depth: arrows
+    are scaled to the wind speed."""
+
+    plotCurrents(reader, uVar, vVar, outputFile, steps, bbox, None, prefetch, "Winds", None, colour)
+
 
-    # get boundaries
-    latMin, latMax, lonMin, lonMax = getBoundaries(ds)
-    
-    # plot them
-    m = Basemap(projection='merc',
-                llcrnrlat=latMin, urcrnrlat=latMax,
-                llcrnrlon=lonMin, urcrnrlon=lonMax,                    
-                resolution='l')
-
-    # add coastlines, states, and country boundaries
-    m.drawcoastlines()
-    m.drawstates()
-    m.drawcountries()
-    
-    # add color
-    m.fillcontinents(color='coral',lake_color='aqua')
-
-    # set the title
-    plt.title(inputFile)
-            
-    # show the plot
-    plt.show()
-    
-    
 #############################################################
 #
-# Plot Winds
+# Plot Currents in parallel
 #
 #############################################################
 
-def plotWinds(ds, inputFile, windVar):
+def renderFrames(job):
+
+    """Render a chunk of time steps to numbered images in a worker
+    process. Every worker opens its own files, since handles
+    cannot be shared between processes, and builds its own
+    background once."""
+
+    inputFiles, names, uVar, vVar, outputFile, steps, bbox, level, prefetch, title, scale, colour, limits, cacheDir = job
+    map_visualiser.basemapCacheDir = cacheDir
+    derived_fields.cacheDir = cacheDir
+
+    reader = nc_reader.NcReader(inputFiles, names)
+    try:
+        plotCurrents(reader, uVar, vVar, outputFile, steps, bbox, level, prefetch, title, scale, colour, limits)
+    finally:
+        reader.close()
+    return steps
 
-    # get boundaries
-    latMin, latMax, lonMin, lonMax = getBoundaries(ds)
-    
-    # plot them
-    m = Basemap(projection='merc',
-                llcrnrlat=latMin, urcrnrlat=latMax,
-                llcrnrlon=lonMin, urcrnrlon=lonMax,                    
-                resolution='l')
 
-    # Add Coastlines, States, and Country Boundaries
-    m.drawcoastlines()
-    m.drawstates()
-    m.drawcountries()
+def plotCurrentsParallel(inputFiles, names, uVar, vVar, outputFile, steps=None, workers=2, bbox=None, level=0, prefetch=PREFETCH_STEPS,
+                         title="Currents", scale=3, colour=DEFAULT_COLOUR):
 
-    # add color
-    m.fillcontinents(color='coral',lake_color='aqua')
+    """Same as plotCurrents with an outputFile, but the time steps
+    are split in contiguous chunks rendered by a pool of worker
+    processes. Animations are assembled, in order, from the images
+    of the workers once they are all done. inputFiles and names
+    are the arguments of NcReader. All the workers use the
+    colour scale of the first step, as plotCurrents does."""
 
-    # set the title
-    plt.title(inputFile)
+    import matplotlib.pyplot as plt
+    plt.switch_backend("Agg")
 
-    # get data for winds
+    # time steps to render, split among the workers, and the
+    # colour scale (the files are closed before the workers start)
+    reader = nc_reader.NcReader(inputFiles, names)
     try:
-        lons = ds.variables[lonVar][:]
-        lats = ds.variables[latVar][:]
-        tmax = ds.variables[windVar][0,:,:]
-    except KeyError:
+        nSteps = reader[uVar].shape[0]
+        allSteps = range(nSteps)[steps or slice(None)]
+        latMin, latMax, lonMin, lonMax = map_visualiser.getMapBounds(reader, bbox)
+        limits = getFirstStepLimits(reader, uVar, vVar, allSteps, bbox, level, colour)
+    except (KeyError, IndexError):
         logger.error("Check your variables!")
-        sys.exit(1)        
-    lon, lat = np.meshgrid(lons, lats)
-    xi, yi = m(lon, lat)
-    cs = m.pcolor(xi, yi, np.squeeze(tmax))
-    
-    # show the plot
-    plt.show()
+        sys.exit(1)
+    finally:
+        reader.close()
+    if not allSteps:
+        logger.error("No time steps selected!")
+        sys.exit(1)
+    size = -(-len(allSteps) // workers)
+    chunks = [allSteps[i:i + size] for i in range(0, len(allSteps), size)]
 
+    # build the projection before starting the workers, so
+    # that they inherit it (or find it on disk)
+    map_visualiser.getBasemap(latMin, latMax, lonMin, lonMax, projection='cyl')
 
-#############################################################
-#
-# Plot Currents
-#
-#############################################################
+    # animations are made from the images of the workers
+    ext = os.path.splitext(outputFile)[1].lower()
+    tmpDir = None
+    framesFile = outputFile
+    if ext in (".mp4", ".gif"):
+        tmpDir = tempfile.mkdtemp()
+        framesFile = os.path.join(tmpDir, "frame_%06d.png")
 
-def plotCurrents(dsU, dsV, uVar, vVar):
+    try:
+        logger.debug("Rendering %s time steps with %s workers" % (len(allSteps), len(chunks)))
+        jobs = [(inputFiles, names, uVar, vVar, framesFile, slice(chunk.start, chunk.stop, chunk.step),
+                 bbox, level, prefetch, title, scale, colour, limits, map_visualiser.basemapCacheDir) for chunk in chunks]
+        with multiprocessing.Pool(len(chunks)) as pool:
+            for done in pool.imap(renderFrames, jobs):
+                logger.debug("Time steps %s to %s rendered" % (done.start, done.stop - 1))
+
+        # encode the animation, in order
+        if tmpDir:
+            image = plt.imread(framesFile % allSteps[0])
+            fig = plt.figure(figsize=(image.shape[1] / FRAME_DPI, image.shape[0] / FRAME_DPI), dpi=FRAME_DPI)
+            ax = fig.add_axes([0, 0, 1, 1])
+            ax.axis("off")
+            im = ax.imshow(image)
+            grab, finish = openFrameWriter(fig, outputFile)
+            for t in allSteps:
+                im.set_data(plt.imread(framesFile % t))
+                grab(t)
+            finish()
+            plt.close(fig)
+
+    finally:
+        if tmpDir:
+            shutil.rmtree(tmpDir)
 
-    # get boundaries
-    latMin, latMax, lonMin, lonMax = getBoundaries(dsU)
-
-    for t in range(24):
-    
-        # create a new figure
-        plt.figure()
-    
-        # get data for currents
-        try:
-            lons = dsU.variables[lonVar][:]
-            lats = dsU.variables[latVar][:]
-            umax = dsU.variables[uVar][t,0,:,:]
-            vmax = dsV.variables[vVar][t,0,:,:]
-            print("Reading variables: ok")
-        except KeyError:
-            logger.error("Check your variables!")
-            sys.exit(1)        
-            
-        # plot them
-        m = Basemap(llcrnrlat=lats.min(), urcrnrlat=lats.max(),
-                    llcrnrlon=lons.min(), urcrnrlon=lons.max(),                    
-                    resolution='l')
-    
-        lat_indexes = getRangeIndexes(lats, lats.min(), lats.max())
-        lon_indexes = getRangeIndexes(lons, lons.min(), lons.max())
-        
-        lats_sel = lats[lat_indexes]
-        lons_sel = lons[lon_indexes]
-        xx, yy = np.meshgrid(lons_sel, lats_sel)
-        
-        # Add Coastlines, States, and Country Boundaries
-        m.drawcoastlines()
-        m.drawstates()
-        m.drawcountries()
-    
-        # add color
-        m.fillcontinents(color='coral',lake_color='aqua')
-    
-        # set the title
-        plt.title("Currents")
-    
-        # color the sea
-        lon, lat = np.meshgrid(lons, lats)
-        xi, yi = m(lon, lat)
-        cs = m.pcolor(xi, yi, np.squeeze(umax))
-    
-        ## draw meridians and parallels
-        step_lat = float((latMax - latMin) / 5)
-        step_lon = float((lonMax - lonMin) / 5)
-    
-        # draw arrows
-        X = lons[::5]
-        Y = lats[::5]
-        UU = umax[::5,::5]
-        VV = vmax[::5,::5]
-        m.quiver(X, Y, UU, VV, scale=3)
-    
-        # show the plot
-        plt.show()
-            
 
 #############################################################
 #
@@ -241,6 +530,7 @@ if __name__ == "__main__":
     logger = logging.getLogger('map_visualiser')
     logger.setLevel(logging.DEBUG)
     logging.getLogger("matplotlib").setLevel(logging.CRITICAL)
+    logging.getLogger("PIL").setLevel(logging.CRITICAL)
     
     
     #############################################################
@@ -251,26 +541,61 @@ if __name__ == "__main__":
 
     inputFiles = None
     function = None
+    names = {}
+    plotVar1, plotVar2 = "u", "v"
+    outputFile = steps = None
+    workers = 1
+    bbox = None
+    levelIndex = 0
+    prefetch = PREFETCH_STEPS
+    textOnly = False
+    colour = DEFAULT_COLOUR
     try:
-        options, rem = getopt.getopt(sys.argv[1:], 'i:hf:p:', ['inputFiles=', 'help', 'latVariable=', 'lonVariable=', 'function=', 'plotVariables='])
+        options, rem = getopt.getopt(sys.argv[1:], 'i:hf:p:o:', ['inputFiles=', 'help', 'latVariable=', 'lonVariable=', 'function=', 'plotVariables=', 'cacheDir=', 'lod=',
+                                                                'outputFile=', 'steps=', 'workers=', 'bbox=', 'time=', 'level=', 'prefetch=', 'colour=', 'text'])
     
         for opt, arg in options:
             if opt in ('-i', '--inputFiles'):
                 inputFiles = arg.split(",")
-                print(inputFiles)
+                logger.debug("Input files: %s" % inputFiles)
             elif opt in ('--latVariable'):                
-                latVar = arg
+                names["lat"] = arg
             elif opt in ('--lonVariable'):                
-                lonVar = arg
+                names["lon"] = arg
             elif opt in ('-f', '--function'):
                 function = arg
             elif opt in ('-p', '--plotVariables'):
                 plotVar1, plotVar2 = arg.split(",")
+            elif opt == '--cacheDir':
+                map_visualiser.basemapCacheDir = arg
+                derived_fields.cacheDir = arg
+            elif opt == '--lod':
+                map_visualiser.lodMethod = arg
+            elif opt in ('-o', '--outputFile'):
+                outputFile = arg
+            elif opt == '--steps':
+                steps = slice(*[int(x) if x else None for x in arg.split(":")])
+            elif opt == '--workers':
+                workers = int(arg)
+            elif opt == '--bbox':
+                bbox = [float(x) for x in arg.split(",")]
+                if len(bbox) != 4:
+                    raise ValueError("bbox must be LATMIN,LATMAX,LONMIN,LONMAX")
+            elif opt == '--time':
+                steps = slice(int(arg), int(arg) + 1)
+            elif opt == '--level':
+                levelIndex = int(arg)
+            elif opt == '--prefetch':
+                prefetch = int(arg)
+            elif opt == '--colour':
+                colour = arg
+            elif opt == '--text':
+                textOnly = True
             elif opt in ('-h', '--help'):
                 showHelp(logger)
                 sys.exit(0)
     
-    except getopt.GetoptError:
+    except (getopt.GetoptError, ValueError, TypeError):
         showHelp(logger)
         sys.exit(1)
 
@@ -286,22 +611,34 @@ if __name__ == "__main__":
     #
     #############################################################
 
-    # open netCDF file
-    dsU = Dataset(inputFiles[0], "r")
-    dsV = Dataset(inputFiles[1], "r")
+    # render in parallel (every worker opens its own files)
+    if (function in ("currents", "winds")) and outputFile and (workers > 1):
+        if function == "currents":
+            plotCurrentsParallel(inputFiles, names, plotVar1, plotVar2, outputFile, steps, workers, bbox, levelIndex, prefetch,
+                                 "Currents", 3, colour)
+        else:
+            plotCurrentsParallel(inputFiles, names, plotVar1, plotVar2, outputFile, steps, workers, bbox, None, prefetch,
+                                 "Winds", None, colour)
+        sys.exit(0)
+
+    # headers only
+    if function == "info":
+        getInfo(inputFiles)
+        sys.exit(0)
+
+    # open netCDF files
+    reader = nc_reader.NcReader(inputFiles, names)
 
     # invoke the proper function
-    if function == "boundaries":
-        plotBoundaries(ds, inputFile)
+    if (function == "boundaries") and textOnly:
+        map_visualiser.printBoundaries(reader, bbox)
+    elif function == "boundaries":
+        map_visualiser.plotBoundaries(reader, ",".join(inputFiles), bbox)
     elif function == "winds":
-        plotWinds(dsU, dsV, inputFile, plotVar1, plotVar2)
+        plotWinds(reader, plotVar1, plotVar2, outputFile, steps, bbox, prefetch, colour)
     elif function == "currents":
         print("CURRENTS")
-        plotCurrents(dsU, dsV, plotVar1, plotVar2)
+        plotCurrents(reader, plotVar1, plotVar2, outputFile, steps, bbox, levelIndex, prefetch, "Currents", 3, colour)
 
-        # close files
-        dsU.close()
-        dsV.close()
-        
-    elif function == "info":
-        getInfo(ds)
+    # close files
+    reader.close()
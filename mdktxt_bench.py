@@ -0,0 +1,294 @@
+#!/bin/python3
+#
+# This script benchmarks the conversion of Medslik-II .rel
+# files done by mdktxt_to_nc.py. Synthetic .rel files with
+# the same layout as the Medslik-II ones are generated at the
+# requested sizes, then every stage (parse, grid, write) is
+# timed separately. Results are stored as JSON, so that they
+# can be compared between versions.
+#
+
+
+#############################################################
+#
+# requirements
+#
+#############################################################
+
+# global reqs
+import os
+import sys
+import json
+import time
+import getopt
+import logging
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+import numpy as np
+from datetime import datetime, timedelta
+
+# local reqs
+import mdktxt_to_nc
+
+# default sizes (number of points) and time steps
+DEFAULT_POINTS = "1000,10000,100000,1000000"
+DEFAULT_TIMESTEPS = 3
+
+# columns of the Medslik-II .rel files
+REL_COLUMNS = ["lat", "lon", "SST", "u_srf", "v_srf", "u_10m", "v_10m", "u_30m", "v_30m", "u_120m", "v_120m"]
+
+# logger
+logger = logging.getLogger('mdkbench')
+
+
+#############################################################
+#
+# printHelp
+#
+#############################################################
+
+def printHelp(logger):
+
+    logger.info("  This script benchmarks the .rel to NetCDF conversion.")
+    logger.info("  Parameters are:")
+    logger.info("  --points=<N[,N...]> (grid sizes, default: %s)" % DEFAULT_POINTS)
+    logger.info("  --timesteps=<N> (files per grid size, default: %s)" % DEFAULT_TIMESTEPS)
+    logger.info("  --outputFile=<FILE> (JSON results, default: print them)")
+    logger.info("  --compare=<FILE> (JSON results of a previous run)")
+    logger.info("  --workDir=<DIR> (where synthetic files are created, default: a temporary one)")
+
+
+#############################################################
+#
+# makeRel
+#
+#############################################################
+
+def makeRel(outputFile, nLat, nLon, fileTime, seed=0, step=1 / 12.):
+
+    """Write a synthetic .rel file with the Medslik-II layout.
+
+    The grid has nLat x nLon points spaced by step degrees (less
+    for large grids, so that they stay within 30-85N and 360
+    degrees of longitude); about one cell out of three is left
+    out, as land points are in the real files. Returns the number
+    of points written."""
+
+    rng = np.random.default_rng(seed)
+    latMin, lonMin = 30.0, -5.0
+    step = min(step, 55.0 / max(1, nLat - 1), 359.0 / max(1, nLon - 1))
+    lats = latMin + step * np.arange(nLat)
+    lons = lonMin + step * np.arange(nLon)
+
+    # lon-major order, as in the Medslik-II output
+    lon, lat = [a.ravel() for a in np.meshgrid(lons, lats, indexing="ij")]
+    sea = rng.random(lat.size) > 0.33
+    lat, lon = lat[sea], lon[sea]
+
+    data = np.empty((lat.size, len(REL_COLUMNS)))
+    data[:, 0] = lat
+    data[:, 1] = lon
+    data[:, 2] = 20 + 8 * rng.random(lat.size)
+    data[:, 3:] = rng.normal(0, 0.1, (lat.size, len(REL_COLUMNS) - 3))
+
+    with open(outputFile, "w") as fd:
+        fd.write(" MERCATOR model 9 km forecast data for %s\n" % fileTime.strftime("%d/%m/%Y %H:%M"))
+        fd.write(" Subregion of the Global Ocean:\n")
+        fd.write("  %9.5f %9.5f %9.5f %9.5f %4d %4d   Geog. limits\n" % (lons[0], lons[-1], lats[0], lats[-1], nLon, nLat))
+        fd.write("  %d   0.0\n" % lat.size)
+        fd.write("    " + "".join("%-11s" % c for c in REL_COLUMNS) + "\n")
+        np.savetxt(fd, data, fmt="%11.4f", delimiter="")
+
+    return lat.size
+
+
+#############################################################
+#
+# makeCase / runCase
+#
+#############################################################
+
+def makeCase(case):
+
+    """Generate the input files of one benchmark case. Meant to
+    run in its own process, so that the memory used by the
+    generator is not charged to the conversion.
+
+    Returns the (inputFiles, points, [nLat, nLon]) tuple."""
+
+    nPoints, timeSteps, workDir = case
+    nLat = max(1, int(round(np.sqrt(nPoints * 1.5))))
+    nLon = max(1, int(round(nPoints * 1.5 / nLat)))
+
+    inputFiles = []
+    points = 0
+    start = datetime(2019, 8, 5)
+    for t in range(timeSteps):
+        inputFile = os.path.join(workDir, "bench_%s_%02d.rel" % (nPoints, t))
+        points += makeRel(inputFile, nLat, nLon, start + timedelta(hours=t), seed=t)
+        inputFiles.append(inputFile)
+    return inputFiles, points, [nLat, nLon]
+
+
+def runCase(case):
+
+    """Convert the files of one benchmark case (see makeCase),
+    timing every stage. Meant to run in a fresh process, so that
+    the peak RSS it reports belongs to the conversion of this
+    case only."""
+
+    nPoints, timeSteps, workDir, inputFiles, points, grid = case
+    variables = [("u_10m", "U10M"), ("v_10m", "V10M")]
+    outputFile = os.path.join(workDir, "bench_%s.nc" % nPoints)
+
+    # time the conversion, stage by stage
+    timings = {"parse": 0.0, "grid": 0.0, "write": 0.0}
+    ds = None
+    for index, inputFile in enumerate(inputFiles):
+
+        t0 = time.perf_counter()
+        header, data = mdktxt_to_nc.readRel(inputFile)
+        t1 = time.perf_counter()
+        lats, lons, grids = mdktxt_to_nc.gridRel(data[:, 0], data[:, 1], [data[:, 5], data[:, 6]])
+        t2 = time.perf_counter()
+        if not ds:
+            ds = mdktxt_to_nc.createOutput(outputFile, lats, lons, variables)
+        mdktxt_to_nc.writeSlice(ds, index, mdktxt_to_nc.parseRelTime(header["title"]), variables, grids)
+        ds.sync()
+        t3 = time.perf_counter()
+
+        timings["parse"] += t1 - t0
+        timings["grid"] += t2 - t1
+        timings["write"] += t3 - t2
+    ds.close()
+
+    result = {"size": nPoints,
+              "points": points,
+              "timesteps": timeSteps,
+              "grid": grid,
+              "inputBytes": sum(os.path.getsize(f) for f in inputFiles),
+              "outputBytes": os.path.getsize(outputFile),
+              "peakRSS_MB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.}
+    for stage, seconds in timings.items():
+        result[stage + "_s"] = seconds
+        result[stage + "_pts_per_s"] = points / seconds if seconds else None
+    result["total_s"] = sum(timings.values())
+
+    for f in inputFiles + [outputFile]:
+        os.remove(f)
+    return result
+
+
+#############################################################
+#
+# compareResults
+#
+#############################################################
+
+def compareResults(old, new):
+
+    """Log the ratio between the stage timings of two runs for
+    the cases (requested size and time steps) they have in
+    common, and the cases found in one run only."""
+
+    oldCases = {(r.get("size"), r["timesteps"]): r for r in old["results"]}
+    newCases = {(r["size"], r["timesteps"]): r for r in new["results"]}
+    for case, r in newCases.items():
+        o = oldCases.get(case)
+        if not o:
+            logger.info("%10s points x %s: not in the results of %s" % (case[0], case[1], old.get("version")))
+            continue
+        ratios = ["%s x%.2f" % (stage, r[stage + "_s"] / o[stage + "_s"])
+                  for stage in ("parse", "grid", "write", "total") if o[stage + "_s"]]
+        logger.info("%10s points x %s: %s (vs %s)" % (case[0], case[1], ", ".join(ratios), old.get("version")))
+    for case in oldCases:
+        if not (case in newCases):
+            logger.info("%10s points x %s: only in the results of %s" % (case[0], case[1], old.get("version")))
+
+
+#############################################################
+#
+# Main
+#
+#############################################################
+
+def main(argv):
+
+    """Command line interface: parse argv (without the program
+    name), run the benchmark and return the exit status."""
+
+    sizes = DEFAULT_POINTS
+    timeSteps = DEFAULT_TIMESTEPS
+    outputFile = compareFile = workDir = None
+
+    try:
+        options, rem = getopt.getopt(argv, 'hp:t:o:', ['help', 'points=', 'timesteps=', 'outputFile=', 'compare=', 'workDir='])
+        for opt, arg in options:
+            if opt in ('-p', '--points'):
+                sizes = arg
+            elif opt in ('-t', '--timesteps'):
+                timeSteps = int(arg)
+            elif opt in ('-o', '--outputFile'):
+                outputFile = arg
+            elif opt == '--compare':
+                compareFile = arg
+            elif opt == '--workDir':
+                workDir = arg
+            elif opt in ('-h', '--help'):
+                printHelp(logger)
+                return 0
+        sizes = [int(float(x)) for x in sizes.split(",")]
+    except (getopt.GetoptError, ValueError):
+        logger.error("wrong arguments!")
+        printHelp(logger)
+        return 1
+
+    # version of the code being benchmarked
+    try:
+        version = subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        version = None
+
+    report = {"version": version,
+              "date": datetime.now().isoformat(timespec="seconds"),
+              "python": platform.python_version(),
+              "numpy": np.__version__,
+              "results": []}
+
+    # the inputs of every case are generated in a process and
+    # converted in another one, measured alone
+    with tempfile.TemporaryDirectory(dir=workDir) as tmpDir:
+        ctx = multiprocessing.get_context("spawn")
+        for nPoints in sizes:
+            with ctx.Pool(1) as pool:
+                inputFiles, points, grid = pool.apply(makeCase, ((nPoints, timeSteps, tmpDir),))
+            with ctx.Pool(1) as pool:
+                result = pool.apply(runCase, ((nPoints, timeSteps, tmpDir, inputFiles, points, grid),))
+            logger.info("%10s points x %s: parse %.3fs, grid %.3fs, write %.3fs (%.0f pts/s), peak RSS %.0f MB" %
+                        (nPoints, timeSteps, result["parse_s"], result["grid_s"],
+                         result["write_s"], result["points"] / result["total_s"], result["peakRSS_MB"]))
+            report["results"].append(result)
+
+    if outputFile:
+        with open(outputFile, "w") as fd:
+            json.dump(report, fd, indent=1)
+    else:
+        print(json.dumps(report, indent=1))
+
+    if compareFile:
+        with open(compareFile) as fd:
+            compareResults(json.load(fd), report)
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    # configure logger
+    logging.basicConfig(level=logging.INFO)
+
+    sys.exit(main(sys.argv[1:]))
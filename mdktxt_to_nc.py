@@ -17,18 +17,63 @@
 #############################################################
 
 # global reqs
-import csv
-import pdb
+import io
+import os
+import re
 import sys
-import math
+import json
+import mmap
+import hashlib
+import itertools
+import contextlib
 import getopt
 import logging
-import subprocess
+import multiprocessing
 import numpy as np
+import derived_fields
+from render_cache import expandInputs
 from netCDF4 import Dataset
 from netCDF4 import date2num
 from datetime import datetime
 
+# default columns to export, with the names used by the
+# Medslik-II wind files
+DEFAULT_VARIABLES = "u_10m:U10M,v_10m:V10M"
+
+# default storage options of the output variables
+# (see createOutput)
+DEFAULT_STORAGE = {"complevel": 4,
+                   "shuffle": True,
+                   "chunks": None,
+                   "fixedDims": False,
+                   "packing": {}}
+
+# points parsed at once by readRelChunks
+DEFAULT_CHUNK_ROWS = 200000
+
+# largest packed int16 value
+PACK_MAX = 32767
+
+# units of the time axis
+TIME_UNITS = "hours since 1950-01-01 00:00"
+
+# CF attributes of the coordinates and of the known .rel columns
+COORD_ATTRIBUTES = {"lat": {"standard_name": "latitude", "long_name": "latitude", "units": "degrees_north", "axis": "Y"},
+                    "lon": {"standard_name": "longitude", "long_name": "longitude", "units": "degrees_east", "axis": "X"},
+                    "time": {"standard_name": "time", "long_name": "time", "units": TIME_UNITS, "axis": "T"}}
+COLUMN_ATTRIBUTES = {"SST": {"standard_name": "sea_surface_temperature", "long_name": "sea surface temperature", "units": "degC"}}
+for depth, label in (("srf", "surface"), ("10m", "10 m"), ("30m", "30 m"), ("120m", "120 m")):
+    COLUMN_ATTRIBUTES["u_" + depth] = {"standard_name": "eastward_sea_water_velocity",
+                                       "long_name": "eastward current at %s" % label, "units": "m s-1"}
+    COLUMN_ATTRIBUTES["v_" + depth] = {"standard_name": "northward_sea_water_velocity",
+                                       "long_name": "northward current at %s" % label, "units": "m s-1"}
+    for field, attributes in derived_fields.ATTRIBUTES.items():
+        COLUMN_ATTRIBUTES[field + "_" + depth] = dict(attributes["currents"],
+                                                      long_name="%s at %s" % (attributes["currents"]["long_name"], label))
+
+# logger
+logger = logging.getLogger('mdk2nc')
+
 
 #############################################################
 #
@@ -37,7 +82,918 @@ from datetime import datetime
 #############################################################
 
 def printHelp(logger):
-    logger.error("Not yet implemented!")
+
+    logger.info("  This script converts a Medslik-II .rel file to NetCDF.")
+    logger.info("  Parameters are:")
+    logger.info("  --inputFile=<FILE[,FILE...]|GLOB> (more .rel files are appended as time steps)")
+    logger.info("  --outputFile=<FILE>")
+    logger.info("  --time=<YYYY-MM-DD HH:MM> (default: read from the .rel file)")
+    logger.info("  --variables=<all|COLUMN[:NAME],...> (default: %s)" % DEFAULT_VARIABLES)
+    logger.info("    speed_X, direction_X and vorticity_X columns are derived from u_X and v_X")
+    logger.info("  --workers=<N> (number of parsing processes, default: 1)")
+    logger.info("  --deflate=<0-9> (deflate level, 0 disables compression, default: %s)" % DEFAULT_STORAGE["complevel"])
+    logger.info("  --noShuffle (disable the shuffle filter)")
+    logger.info("  --chunks=<TIME,LAT,LON> (default: one time step by the full lat/lon grid)")
+    logger.info("  --fixedDims (fixed-size lat/lon dimensions instead of unlimited ones)")
+    logger.info("  --pack=<auto|NAME:MIN:MAX,...> (store variables as int16 with scale_factor/add_offset;")
+    logger.info("    auto takes the range of all the inputs, NAME:MIN:MAX is required with --append)")
+    logger.info("  --append (update an existing output, converting only new or changed files)")
+    logger.info("  --chunkRows=<N> (parse files in chunks of N points on the grid of their header, to bound memory, e.g. %s)" % DEFAULT_CHUNK_ROWS)
+
+
+#############################################################
+#
+# parseVariables
+#
+#############################################################
+
+def parseVariables(spec, columns):
+
+    """Turn a variables specification into a list of
+    (column, name) pairs.
+
+    The specification is a comma-separated list of .rel column
+    names, each optionally followed by ":NAME" to rename it in the
+    output file, or "all" to export every non-coordinate column
+    with its own name. Fields derived from a u_X/v_X pair (see
+    derivedColumn) are accepted as columns. Raises ValueError for
+    unknown or coordinate columns and for output names that are
+    repeated or clash with the coordinates."""
+
+    if spec == "all":
+        return [(c, c) for c in columns if not (c in ("lat", "lon"))]
+
+    variables = []
+    for item in spec.split(","):
+        column, _, name = item.partition(":")
+        name = name or column
+        if column in ("lat", "lon"):
+            raise ValueError("Column %s is a coordinate, it is always exported" % column)
+        if not (column in columns or derivedColumn(column, columns)):
+            raise ValueError("Column %s not found (available: %s)" % (column, ", ".join(columns)))
+        if name in COORD_ATTRIBUTES:
+            raise ValueError("Output name %s is reserved for a coordinate" % name)
+        if name in [n for c, n in variables]:
+            raise ValueError("Output name %s is used more than once" % name)
+        variables.append((column, name))
+    return variables
+
+
+def derivedColumn(column, columns):
+
+    """The (field, uColumn, vColumn) tuple of a derived column,
+    named FIELD_X with FIELD speed, direction or vorticity (see
+    derived_fields.py) and computed from the u_X and v_X columns,
+    or None if column is not one or u_X/v_X are not in columns."""
+
+    field, _, suffix = column.partition("_")
+    if (field in derived_fields.ATTRIBUTES) and ("u_" + suffix in columns) and ("v_" + suffix in columns):
+        return field, "u_" + suffix, "v_" + suffix
+    return None
+
+
+#############################################################
+#
+# openRel / sourceName
+#
+#############################################################
+
+@contextlib.contextmanager
+def openRel(source):
+
+    """Context manager yielding a text file object for source,
+    which may be a path or an already open file object. Streams
+    passed by the caller are not closed."""
+
+    if isinstance(source, (str, bytes, os.PathLike)):
+        with open(source) as fd:
+            yield fd
+    elif isinstance(source, (io.RawIOBase, io.BufferedIOBase)):
+        fd = io.TextIOWrapper(source)
+        try:
+            yield fd
+        finally:
+            fd.detach()
+    else:
+        yield source
+
+
+def sourceName(source):
+
+    """Name of a .rel source, used for messages and to get the
+    time from the file name."""
+
+    if isinstance(source, (str, bytes, os.PathLike)):
+        return os.fsdecode(source)
+    return getattr(source, "name", "<stream>")
+
+
+#############################################################
+#
+# readRelHeader
+#
+#############################################################
+
+def readRelHeader(fd):
+
+    """Read the header of a .rel file from an open file object,
+    leaving it positioned at the first row of the numeric block.
+
+    The header is made of the title line, a free text line, the
+    "Geog. limits" line (lon min/max, lat min/max, lon/lat grid
+    counts), the number of points and the column names."""
+
+    # 1. title and description
+    title = fd.readline().strip()
+    fd.readline()
+
+    # 2. geographical limits and grid size
+    limits = fd.readline().split()
+    lonMin, lonMax, latMin, latMax = [float(x) for x in limits[0:4]]
+    nLon, nLat = int(limits[4]), int(limits[5])
+
+    # 3. number of points
+    nPoints = int(fd.readline().split()[0])
+
+    # 4. column names
+    columns = fd.readline().split()
+
+    return {"title": title,
+            "lonMin": lonMin, "lonMax": lonMax,
+            "latMin": latMin, "latMax": latMax,
+            "nLon": nLon, "nLat": nLat,
+            "nPoints": nPoints,
+            "columns": columns}
+
+
+#############################################################
+#
+# readRel
+#
+#############################################################
+
+def readRel(source):
+
+    """Parse a Medslik-II .rel file in a single pass.
+
+    source is either a path or an open (text or binary) file
+    object. The header is read with readRelHeader and the numeric
+    block that follows is loaded straight into a 2-D float array
+    with one column per header name.
+
+    Returns a (header, data) tuple."""
+
+    with openRel(source) as fd:
+        header = readRelHeader(fd)
+        data = np.loadtxt(fd, dtype=np.float64, ndmin=2, max_rows=header["nPoints"])
+
+    if data.shape[1] != len(header["columns"]):
+        raise ValueError("%s: expected %s columns, found %s" % (sourceName(source), len(header["columns"]), data.shape[1]))
+
+    return header, data
+
+
+#############################################################
+#
+# gridRel
+#
+#############################################################
+
+def gridRel(lat, lon, fields):
+
+    """Scatter point values onto the regular lat/lon grid they
+    belong to.
+
+    The axes are the sorted unique coordinates; the grid index of
+    every point is found by binary search and all the values of a
+    field are copied with a single fancy-indexed assignment into a
+    NaN-prefilled float32 (time, lat, lon) array. If a grid cell
+    appears more than once the first occurrence wins.
+
+    Returns a (lats, lons, grids) tuple."""
+
+    # 1. axes
+    lats = np.unique(lat)
+    lons = np.unique(lon)
+
+    # 2. grid indexes of every point (reversed, so that the
+    #    first occurrence of a duplicated cell is the last written)
+    iLat = np.searchsorted(lats, lat)[::-1]
+    iLon = np.searchsorted(lons, lon)[::-1]
+
+    # 3. scatter
+    grids = []
+    for values in fields:
+        grid = np.full((1, len(lats), len(lons)), np.nan, dtype=np.float32)
+        grid[0, iLat, iLon] = values[::-1]
+        grids.append(grid)
+
+    return lats, lons, grids
+
+
+#############################################################
+#
+# readRelChunks / gridRelChunks
+#
+#############################################################
+
+def readRelChunks(source, chunkRows=DEFAULT_CHUNK_ROWS):
+
+    """Parse a .rel file in chunks of at most chunkRows points,
+    so that the numeric block is never loaded as a whole. Files
+    given by path are memory mapped and cut into chunks at line
+    boundaries; open streams are read line by line.
+
+    Yields (header, data) tuples, at least one (with an empty
+    data block if the file has no points)."""
+
+    name = sourceName(source)
+    def parse(lines, header, maxRows):
+        data = np.loadtxt(lines, dtype=np.float64, ndmin=2, max_rows=maxRows)
+        if data.size and (data.shape[1] != len(header["columns"])):
+            raise ValueError("%s: expected %s columns, found %s" % (name, len(header["columns"]), data.shape[1]))
+        return data.reshape(-1, len(header["columns"]))
+
+    if isinstance(source, (str, bytes, os.PathLike)):
+        with open(source, "rb") as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+
+            # the header is made of the first 5 lines
+            pos = 0
+            for n in range(5):
+                pos = mm.find(b"\n", pos) + 1
+                if not pos:
+                    raise ValueError("%s: truncated header" % name)
+            header = readRelHeader(io.StringIO(mm[:pos].decode()))
+
+            # chunks are cut at the end of the line following
+            # chunkRows times the length of the first one; the
+            # pages already parsed are released, so that they do
+            # not add up in memory
+            lineBytes = max(1, mm.find(b"\n", pos) + 1 - pos)
+            rows = 0
+            while True:
+                end = mm.find(b"\n", pos + chunkRows * lineBytes - 1) + 1 or len(mm)
+                data = parse(mm[pos:end].decode().splitlines(), header, header["nPoints"] - rows)
+                rows += len(data)
+                pos = end
+                if hasattr(mm, "madvise"):
+                    mm.madvise(mmap.MADV_DONTNEED, 0, pos - pos % mmap.PAGESIZE)
+                yield header, data
+                if (rows >= header["nPoints"]) or (pos >= len(mm)):
+                    break
+    else:
+        with openRel(source) as fd:
+            header = readRelHeader(fd)
+            rows = 0
+            while True:
+                lines = list(itertools.islice(fd, min(chunkRows, header["nPoints"] - rows)))
+                data = parse(lines, header, None)
+                rows += len(data)
+                yield header, data
+                if (not lines) or (rows >= header["nPoints"]):
+                    break
+
+
+def headerAxes(header):
+
+    """The regular lat/lon axes described by the "Geog. limits"
+    line of a .rel header (min, max and number of points)."""
+
+    return (np.linspace(header["latMin"], header["latMax"], header["nLat"]),
+            np.linspace(header["lonMin"], header["lonMax"], header["nLon"]))
+
+
+def gridRelChunks(header, chunks, latColumn, lonColumn, fieldColumns):
+
+    """Same as gridRel, one chunk of points at a time (see
+    readRelChunks): the grid is the one of the header (see
+    headerAxes), every point goes to the nearest grid cell and
+    is copied into the output slices straight away, so that only
+    one chunk and one (1, lat, lon) slice per field are in memory.
+    Axis values are replaced by the coordinates of the points
+    found on them; points off the grid are dropped with a
+    warning. If a grid cell appears more than once the first
+    occurrence wins.
+
+    Returns a (lats, lons, grids) tuple."""
+
+    lats, lons = headerAxes(header)
+    nLat, nLon = len(lats), len(lons)
+    latStep = (lats[-1] - lats[0]) / (nLat - 1) if nLat > 1 else 1.0
+    lonStep = (lons[-1] - lons[0]) / (nLon - 1) if nLon > 1 else 1.0
+
+    grids = [np.full((1, nLat, nLon), np.nan, dtype=np.float32) for column in fieldColumns]
+    filled = np.zeros(nLat * nLon, dtype=bool)
+    dropped = 0
+    for data in chunks:
+
+        # nearest grid cell of every point
+        lat, lon = data[:, latColumn], data[:, lonColumn]
+        iLat = np.rint((lat - lats[0]) / latStep).astype(np.int64)
+        iLon = np.rint((lon - lons[0]) / lonStep).astype(np.int64)
+        inside = (iLat >= 0) & (iLat < nLat) & (iLon >= 0) & (iLon < nLon)
+        dropped += len(data) - np.count_nonzero(inside)
+        rows = np.flatnonzero(inside)
+        iLat, iLon = iLat[rows], iLon[rows]
+        lats[iLat] = lat[rows]
+        lons[iLon] = lon[rows]
+
+        # first occurrence of the cells not filled yet
+        cells, first = np.unique(iLat * nLon + iLon, return_index=True)
+        new = ~filled[cells]
+        cells, rows = cells[new], rows[first[new]]
+        filled[cells] = True
+        for grid, column in zip(grids, fieldColumns):
+            grid.reshape(-1)[cells] = data[rows, column]
+
+    if dropped:
+        logger.warning("%s points out of the %s x %s grid of the header were dropped" % (dropped, nLat, nLon))
+    return lats, lons, grids
+
+
+#############################################################
+#
+# parseRelTime / readRelTime
+#
+#############################################################
+
+def parseRelTime(title, fileName=""):
+
+    """Get the timestamp of a .rel file.
+
+    The time is read from the title line ("... forecast data for
+    05/08/2019 20:00") or, if missing, from the YYMMDDHH part of
+    the file name (e.g. relo19080520.rel). Returns None when
+    neither is available or holds a valid date."""
+
+    match = re.search(r"(\d{2})/(\d{2})/(\d{4})\s+(\d{1,2}):(\d{2})", title)
+    if match:
+        day, month, year, hour, minute = [int(x) for x in match.groups()]
+        try:
+            return datetime(year, month, day, hour, minute)
+        except ValueError:
+            logger.warning("Invalid date in the title of %s" % (fileName or "the .rel file"))
+
+    match = re.search(r"(\d{2})(\d{2})(\d{2})(\d{2})", os.path.basename(fileName))
+    if match:
+        year, month, day, hour = [int(x) for x in match.groups()]
+        try:
+            return datetime(2000 + year, month, day, hour)
+        except ValueError:
+            logger.warning("Invalid date in the name of %s" % fileName)
+
+    return None
+
+
+def readRelTime(inputFile):
+
+    """Get the timestamp of a .rel file reading only its first
+    line (see parseRelTime)."""
+
+    with open(inputFile) as fd:
+        title = fd.readline()
+    return parseRelTime(title, inputFile)
+
+
+#############################################################
+#
+# loadRel
+#
+#############################################################
+
+def loadRel(source, variables=DEFAULT_VARIABLES, timeStep=None, chunkRows=None):
+
+    """Turn a .rel file into in-memory gridded arrays.
+
+    source is a path or an open file object, variables either a
+    specification accepted by parseVariables or a list of
+    (column, name) pairs, and timeStep overrides the time found
+    in the file. With chunkRows the file is parsed and gridded
+    in chunks of that many points, on the grid of its header (see
+    readRelChunks and gridRelChunks). Derived columns (see
+    derivedColumn) are computed from the gridded u/v columns.
+
+    Returns a dict with the keys "source", "time", "lats", "lons",
+    "variables" (the (column, name) pairs) and "grids" (one
+    float32 (1, lat, lon) array per variable)."""
+
+    name = sourceName(source)
+    if chunkRows:
+        chunks = readRelChunks(source, chunkRows)
+        header, data = next(chunks)
+    else:
+        header, data = readRel(source)
+    columns = header["columns"]
+    if isinstance(variables, str):
+        variables = parseVariables(variables, columns)
+    # the columns to grid: those exported and the u/v of
+    # the derived ones
+    derived = {}
+    gridded = []
+    for column, varName in variables:
+        if column in columns:
+            sources = [column]
+        elif derivedColumn(column, columns):
+            derived[column] = derivedColumn(column, columns)
+            sources = derived[column][1:]
+        else:
+            raise ValueError("Column %s not found" % column)
+        gridded += [c for c in sources if not (c in gridded)]
+
+    fileTime = timeStep or parseRelTime(header["title"], name)
+    if chunkRows:
+        lats, lons, fields = gridRelChunks(header, itertools.chain([data], (d for h, d in chunks)),
+                                           columns.index("lat"), columns.index("lon"),
+                                           [columns.index(column) for column in gridded])
+    else:
+        lats, lons, fields = gridRel(data[:, columns.index("lat")],
+                                     data[:, columns.index("lon")],
+                                     [data[:, columns.index(column)] for column in gridded])
+
+    fields = dict(zip(gridded, fields))
+    grids = []
+    for column, varName in variables:
+        if column in derived:
+            field, uColumn, vColumn = derived[column]
+            kind = derived_fields.getKind(COLUMN_ATTRIBUTES.get(uColumn, {}))
+            grid = derived_fields.compute(field, fields[uColumn], fields[vColumn], lats, lons, kind)
+            grids.append(np.ma.filled(grid, np.nan).astype(np.float32))
+        else:
+            grids.append(fields[column])
+
+    return {"source": name,
+            "time": fileTime,
+            "lats": lats,
+            "lons": lons,
+            "variables": variables,
+            "grids": grids}
+
+
+#############################################################
+#
+# processRel
+#
+#############################################################
+
+def processRel(job):
+
+    """Parse and grid a single .rel file.
+
+    job is an (inputFile, fileTime, variables, chunkRows) tuple
+    (see loadRel), so that the
+    function can be mapped over a process pool. Errors are not
+    raised but returned, so that a broken file does not abort a
+    whole batch.
+
+    Returns an (inputFile, fileTime, lats, lons, grids, error)
+    tuple."""
+
+    inputFile, fileTime, variables, chunkRows = job
+    try:
+        rel = loadRel(inputFile, variables, fileTime, chunkRows)
+    except Exception as e:
+        return inputFile, fileTime, None, None, None, "%s: %s" % (type(e).__name__, e)
+
+    return inputFile, fileTime, rel["lats"], rel["lons"], rel["grids"], None
+
+
+#############################################################
+#
+# resolvePacking
+#
+#############################################################
+
+def gridRanges(variables, grids, ranges=None):
+
+    """Update ranges, a {name: (min, max)} dict, with the range
+    of the finite values of the grids of variables, and return
+    it."""
+
+    ranges = {} if ranges is None else ranges
+    for (column, name), grid in zip(variables, grids):
+        if np.isfinite(grid).any():
+            vmin, vmax = np.nanmin(grid), np.nanmax(grid)
+            if name in ranges:
+                vmin, vmax = min(vmin, ranges[name][0]), max(vmax, ranges[name][1])
+            ranges[name] = (vmin, vmax)
+    return ranges
+
+
+def resolvePacking(spec, ranges=None):
+
+    """Compute the int16 scale_factor/add_offset of the variables
+    to pack.
+
+    spec is either "auto", to pack every variable of ranges (see
+    gridRanges, which must cover all the data to write) in its
+    range, or a comma-separated list of NAME:MIN:MAX items.
+    Returns a {name: (scale, offset)} dict."""
+
+    ranges = dict(ranges or {}) if spec == "auto" else {}
+    if spec and (spec != "auto"):
+        for item in spec.split(","):
+            try:
+                name, vmin, vmax = item.split(":")
+                ranges[name] = (float(vmin), float(vmax))
+            except ValueError:
+                raise ValueError("wrong packing specification %s" % item)
+
+    # leave the lowest value for the fill value and one
+    # step of margin for rounding at both ends
+    packing = {}
+    for name, (vmin, vmax) in ranges.items():
+        scale = float(vmax - vmin) / (2 * PACK_MAX - 2) or 1.0
+        offset = float(vmax + vmin) / 2
+        packing[name] = (scale, offset)
+    return packing
+
+
+#############################################################
+#
+# createOutput
+#
+#############################################################
+
+def createOutput(outputFile, lats, lons, variables, storage=DEFAULT_STORAGE, diskless=False):
+
+    """Create the output netCDF4 file with the lat, lon and time
+    dimensions, the coordinate variables and one (time, lat, lon)
+    variable for every (column, name) pair of variables.
+
+    storage may hold the keys of DEFAULT_STORAGE: "complevel"
+    (deflate level, 0 disables compression), "shuffle", "chunks"
+    (a (time, lat, lon) chunk shape, default one time step by the
+    full lat/lon grid), "fixedDims" (fixed-size lat/lon dimensions
+    instead of unlimited ones) and "packing" (a {name: (scale,
+    offset)} dict of variables to store as packed int16). With
+    diskless the Dataset only lives in memory and outputFile is
+    just its name.
+
+    Returns the open Dataset."""
+
+    storage = dict(DEFAULT_STORAGE, **storage)
+
+    # open the output netCDF4 file
+    logger.debug("Initialising output netCDF4 file")
+    ds = Dataset(outputFile, "w", diskless=diskless, persist=False)
+
+    logger.debug("Setting attributes")
+    ds.Conventions = "CF-1.6"
+
+    # create dimensions lat, lon, time
+    logger.debug("Creating dimensions")
+    if storage["fixedDims"]:
+        ds.createDimension("lat", len(lats))
+        ds.createDimension("lon", len(lons))
+    else:
+        ds.createDimension("lat")
+        ds.createDimension("lon")
+    ds.createDimension("time")
+
+    # create variables
+    logger.debug("Creating variables")
+    lat_var = ds.createVariable("lat", np.float32, ("lat",))
+    lon_var = ds.createVariable("lon", np.float32, ("lon",))
+    time_var = ds.createVariable("time", np.int32, ("time",))
+    for var in (lat_var, lon_var, time_var):
+        var.setncatts(COORD_ATTRIBUTES[var.name])
+    chunks = storage["chunks"] or (1, len(lats), len(lons))
+    chunks = (chunks[0], min(chunks[1], len(lats)), min(chunks[2], len(lons)))
+    for column, name in variables:
+        if name in storage["packing"]:
+            scale, offset = storage["packing"][name]
+            var = ds.createVariable(name, np.int16, ("time", "lat", "lon",),
+                                    zlib=storage["complevel"] > 0, complevel=storage["complevel"] or 4,
+                                    shuffle=storage["shuffle"], chunksizes=chunks,
+                                    fill_value=-PACK_MAX - 1)
+            var.scale_factor = scale
+            var.add_offset = offset
+        else:
+            var = ds.createVariable(name, np.float32, ("time", "lat", "lon",),
+                                    zlib=storage["complevel"] > 0, complevel=storage["complevel"] or 4,
+                                    shuffle=storage["shuffle"], chunksizes=chunks,
+                                    fill_value=np.float32(np.nan))
+        var.setncatts(COLUMN_ATTRIBUTES.get(column, {"long_name": column}))
+
+    # fill coordinates
+    lat_var[:] = lats
+    lon_var[:] = lons
+
+    return ds
+
+
+#############################################################
+#
+# writeSlice
+#
+#############################################################
+
+def writeSlice(ds, index, timeStep, variables, grids):
+
+    """Write the gridded fields of one .rel file as the time
+    slice number index of the output Dataset.
+
+    Missing cells are written as the variable fill value. Values
+    of packed variables outside the range their scale_factor and
+    add_offset can represent are clipped."""
+
+    ds.variables["time"][index] = date2num(timeStep, TIME_UNITS)
+    for (column, name), grid in zip(variables, grids):
+        var = ds.variables[name]
+        data = np.ma.masked_invalid(grid[0,:,:])
+        if "scale_factor" in var.ncattrs():
+            data = np.ma.array(data.filled(var.add_offset), mask=np.ma.getmaskarray(data))
+            vmin = var.add_offset - PACK_MAX * var.scale_factor
+            vmax = var.add_offset + PACK_MAX * var.scale_factor
+            if (data < vmin).any() or (data > vmax).any():
+                logger.warning("%s values outside the packing range [%s, %s] have been clipped" % (name, vmin, vmax))
+                data = np.ma.clip(data, vmin, vmax)
+        var[index,:,:] = data
+
+
+#############################################################
+#
+# writeRel
+#
+#############################################################
+
+def writeRel(outputFile, rel, storage=DEFAULT_STORAGE, diskless=False):
+
+    """Write a single dict returned by loadRel to a new netCDF4
+    file (or to an in-memory one, with diskless) and return the
+    open Dataset."""
+
+    ds = createOutput(outputFile, rel["lats"], rel["lons"], rel["variables"], storage, diskless)
+    writeSlice(ds, 0, rel["time"], rel["variables"], rel["grids"])
+    return ds
+
+
+#############################################################
+#
+# toArrays / toXarray
+#
+#############################################################
+
+def toArrays(rels):
+
+    """Turn one or more dicts returned by loadRel (sharing the
+    same axes and variables) into a dict of NumPy arrays, without
+    going through a NetCDF file.
+
+    The result holds the "time" (datetime64), "lat" and "lon"
+    coordinate vectors, one (time, lat, lon) float32 array per
+    variable and an "attrs" dict with the CF attributes of each
+    of them."""
+
+    if isinstance(rels, dict):
+        rels = [rels]
+    variables = rels[0]["variables"]
+
+    arrays = {"time": np.array([rel["time"] for rel in rels], dtype="datetime64[s]"),
+              "lat": rels[0]["lats"],
+              "lon": rels[0]["lons"],
+              "attrs": {}}
+    for coord in ("lat", "lon", "time"):
+        arrays["attrs"][coord] = dict(COORD_ATTRIBUTES[coord])
+    del arrays["attrs"]["time"]["units"]
+    for i, (column, name) in enumerate(variables):
+        arrays[name] = np.concatenate([rel["grids"][i] for rel in rels])
+        arrays["attrs"][name] = dict(COLUMN_ATTRIBUTES.get(column, {"long_name": column}))
+    return arrays
+
+
+def toXarray(rels):
+
+    """Same as toArrays, but returns an xarray.Dataset with CF
+    attributes (time is encoded with TIME_UNITS if written).
+    Requires xarray."""
+
+    try:
+        import xarray as xr
+    except ImportError:
+        raise ImportError("toXarray requires xarray, use toArrays instead")
+
+    arrays = toArrays(rels)
+    attrs = arrays.pop("attrs")
+    coords = {coord: (coord, arrays.pop(coord), attrs.pop(coord)) for coord in ("time", "lat", "lon")}
+    xds = xr.Dataset({name: (("time", "lat", "lon"), data, attrs[name]) for name, data in arrays.items()},
+                     coords=coords, attrs={"Conventions": "CF-1.6"})
+    xds["time"].encoding["units"] = TIME_UNITS
+    return xds
+
+
+#############################################################
+#
+# Manifest
+#
+#############################################################
+
+def loadManifest(manifestFile):
+
+    """Load the sidecar manifest of an output file: a
+    {source path: {"size", "mtime", "sha1", "time"}} dict of the
+    .rel files already written into it."""
+
+    try:
+        with open(manifestFile) as fd:
+            return json.load(fd)
+    except FileNotFoundError:
+        return {}
+
+
+def saveManifest(manifestFile, manifest):
+
+    """Atomically replace the sidecar manifest."""
+
+    with open(manifestFile + ".tmp", "w") as fd:
+        json.dump(manifest, fd, indent=1, sort_keys=True)
+    os.replace(manifestFile + ".tmp", manifestFile)
+
+
+def sourceState(inputFile, entry=None):
+
+    """Get the manifest entry (size, mtime and SHA-1) of a source
+    file and tell whether it is unchanged with respect to the old
+    entry. The file is hashed only if size or mtime changed.
+
+    Returns a (entry, unchanged) tuple."""
+
+    st = os.stat(inputFile)
+    if entry and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime_ns:
+        return entry, True
+
+    sha1 = hashlib.sha1()
+    with open(inputFile, "rb") as fd:
+        for block in iter(lambda: fd.read(1 << 20), b""):
+            sha1.update(block)
+    newEntry = {"size": st.st_size, "mtime": st.st_mtime_ns, "sha1": sha1.hexdigest()}
+    return newEntry, bool(entry) and entry["sha1"] == newEntry["sha1"]
+
+
+#############################################################
+#
+# convertRel
+#
+#############################################################
+
+def convertRel(inputFiles, outputFile, variables=DEFAULT_VARIABLES, timeStep=None,
+               workers=1, storage=DEFAULT_STORAGE, packSpec=None, append=False, chunkRows=None):
+
+    """Convert a list of .rel files into a single NetCDF time
+    series.
+
+    Files are sorted by time (timeStep overrides it and is only
+    allowed for a single file); they are parsed and gridded by
+    workers processes, while the output is written here, in time
+    order. The lat/lon axes are taken from the first file and the
+    other ones must match them. A file that cannot be converted
+    is reported and skipped.
+
+    With append, an existing output is updated instead of being
+    replaced: its axes and variables are kept, and only the files
+    that are new or changed since the last run, according to the
+    <outputFile>.manifest.json sidecar, are converted. Their
+    slices overwrite the ones with the same time or are appended.
+
+    With chunkRows, files are parsed in chunks of that many points
+    (see loadRel), to bound the memory used by huge files.
+
+    With packSpec "auto" the packing range of the variables is
+    taken over all the files, which are read twice for that (see
+    resolvePacking); it cannot be used with append.
+
+    Returns the list of the files that failed. Raises ValueError
+    if nothing can be converted at all."""
+
+    storage = dict(DEFAULT_STORAGE, **storage)
+    if timeStep and len(inputFiles) > 1:
+        raise ValueError("a time step can only be forced for a single input file")
+    if append and (packSpec == "auto"):
+        raise ValueError("packing ranges must be given as NAME:MIN:MAX with --append")
+    if packSpec != "auto":
+        storage["packing"] = resolvePacking(packSpec)
+
+    # get the timestamp of every input file and sort them
+    jobs = []
+    failed = []
+    for inputFile in inputFiles:
+        try:
+            fileTime = timeStep or readRelTime(inputFile)
+        except (OSError, ValueError):
+            fileTime = None
+        if not fileTime:
+            logger.error("Cannot get the time of %s, skipping it" % inputFile)
+            failed.append(inputFile)
+            continue
+        jobs.append((fileTime, inputFile))
+    jobs.sort()
+    if not jobs:
+        raise ValueError("No input file to process!")
+
+    # the columns to export are taken from the first file
+    if isinstance(variables, str):
+        try:
+            with open(jobs[0][1]) as fd:
+                variables = parseVariables(variables, readRelHeader(fd)["columns"])
+        except OSError as e:
+            raise ValueError(str(e))
+
+    # open the output to update and skip the unchanged inputs
+    ds = None
+    timeIndex = {}
+    manifest = {}
+    states = {}
+    manifestFile = outputFile + ".manifest.json"
+    if append:
+        manifest = loadManifest(manifestFile)
+        if os.path.exists(outputFile):
+            ds = Dataset(outputFile, "a")
+            for column, name in variables:
+                if not (name in ds.variables):
+                    ds.close()
+                    raise ValueError("%s has no variable %s to append to" % (outputFile, name))
+            firstFile, firstLats, firstLons = outputFile, ds.variables["lat"][:], ds.variables["lon"][:]
+            timeIndex = {int(t): index for index, t in enumerate(ds.variables["time"][:])}
+        changed = []
+        for fileTime, inputFile in jobs:
+            key = os.path.abspath(inputFile)
+            states[inputFile], unchanged = sourceState(inputFile, manifest.get(key))
+            if unchanged and (int(date2num(fileTime, TIME_UNITS)) in timeIndex):
+                logger.debug("%s is unchanged, skipping it" % inputFile)
+                manifest[key] = dict(states[inputFile], time=fileTime.isoformat())
+            else:
+                changed.append((fileTime, inputFile))
+        logger.info("%s of %s file(s) to convert" % (len(changed), len(jobs)))
+        jobs = changed
+
+    jobs = [(inputFile, fileTime, variables, chunkRows) for fileTime, inputFile in jobs]
+
+    # parse and grid the files in the worker processes (if any)
+    # and serialise the writes here, in time order
+    if workers > 1:
+        logger.debug("Using %s worker processes" % workers)
+        pool = multiprocessing.Pool(workers)
+        mapper = pool.imap
+    else:
+        pool = None
+        mapper = map
+
+    try:
+        # with --pack=auto the packing ranges cover all the files,
+        # so that no value is clipped: they are read in a first
+        # pass (a single file is kept in memory instead)
+        if packSpec == "auto":
+            passed = list(mapper(processRel, jobs)) if len(jobs) == 1 else mapper(processRel, jobs)
+            ranges = {}
+            for inputFile, fileTime, lats, lons, grids, error in passed:
+                if not error:
+                    gridRanges(variables, grids, ranges)
+            storage["packing"] = resolvePacking(packSpec, ranges)
+            results = passed if len(jobs) == 1 else mapper(processRel, jobs)
+        else:
+            results = mapper(processRel, jobs)
+
+        for count, (inputFile, fileTime, lats, lons, grids, error) in enumerate(results, 1):
+
+            # report failures and go on with the batch
+            if error:
+                logger.error("[%s/%s] %s failed: %s" % (count, len(jobs), inputFile, error))
+                failed.append(inputFile)
+                continue
+
+            # the axes are computed from the first file and
+            # all the other ones must match them
+            if not ds:
+                ds = createOutput(outputFile, lats, lons, variables, storage)
+                firstFile, firstLats, firstLons = inputFile, lats, lons
+            elif not (np.array_equal(np.float32(lats), np.float32(firstLats)) and
+                      np.array_equal(np.float32(lons), np.float32(firstLons))):
+                logger.error("[%s/%s] %s failed: lat/lon axes differ from the ones of %s" % (count, len(jobs), inputFile, firstFile))
+                failed.append(inputFile)
+                continue
+
+            # push data into netCDF variables, replacing the
+            # slice with the same time, if any
+            t = int(date2num(fileTime, TIME_UNITS))
+            if timeIndex and not (t in timeIndex) and (t < max(timeIndex)):
+                logger.warning("%s is older than the last time step and is appended out of order" % inputFile)
+            index = timeIndex.get(t, len(ds.dimensions["time"]))
+            writeSlice(ds, index, fileTime, variables, grids)
+            timeIndex[t] = index
+            logger.info("[%s/%s] %s written (%s)" % (count, len(jobs), inputFile, fileTime))
+            if append:
+                manifest[os.path.abspath(inputFile)] = dict(states[inputFile], time=fileTime.isoformat())
+
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        if ds:
+            ds.close()
+        if append:
+            saveManifest(manifestFile, manifest)
+
+    return failed
 
 
 #############################################################
@@ -46,52 +1002,74 @@ def printHelp(logger):
 #
 #############################################################
 
-if __name__ == "__main__":
+def main(argv):
 
-    #############################################################
-    #
-    # Configure logger
-    #
-    #############################################################
+    """Command line interface: parse argv (without the program
+    name), run convertRel and return the exit status."""
 
-    logging.basicConfig(level=logging.DEBUG)
-    logger = logging.getLogger('mdk2nc')
-    logger.setLevel(logging.DEBUG)
-    
-    
     #############################################################
     #
     # Process command-line arguments
     #
     #############################################################
 
-    inputFile = outputFile = timeStep = None
+    inputSpecs = []
+    outputFile = timeStep = None
+    variablesSpec = DEFAULT_VARIABLES
+    workers = 1
+    storage = dict(DEFAULT_STORAGE)
+    packSpec = None
+    append = False
+    chunkRows = None
     
     try:
-        options, rem = getopt.getopt(sys.argv[1:], 'i:o:ht:', ['inputFile=', 'outputFile=','help', "time="])
+        options, rem = getopt.getopt(argv, 'i:o:ht:v:w:', ['inputFile=', 'outputFile=','help', "time=", "variables=", "workers=",
+                                                           "deflate=", "noShuffle", "chunks=", "fixedDims", "pack=", "append",
+                                                           "chunkRows="])
     
         for opt, arg in options:
             if opt in ('-i', '--inputFile'):
-                inputFile = arg
-                csvFile = inputFile + ".csv"
-                outputFile = inputFile + ".nc"
+                inputSpecs.append(arg)
             elif opt in ('-o', '--outputFile'):
                 outputFile = arg
             elif opt in ('-t', '--time'):
-                timeStep = arg
+                timeStep = datetime.fromisoformat(arg)
+            elif opt in ('-v', '--variables'):
+                variablesSpec = arg
+            elif opt in ('-w', '--workers'):
+                workers = int(arg)
+            elif opt == '--deflate':
+                storage["complevel"] = int(arg)
+            elif opt == '--noShuffle':
+                storage["shuffle"] = False
+            elif opt == '--chunks':
+                storage["chunks"] = tuple(int(x) for x in arg.split(","))
+                if len(storage["chunks"]) != 3:
+                    raise ValueError("chunks must be time,lat,lon")
+            elif opt == '--fixedDims':
+                storage["fixedDims"] = True
+            elif opt == '--pack':
+                packSpec = arg
+            elif opt == '--append':
+                append = True
+            elif opt == '--chunkRows':
+                chunkRows = int(arg)
             elif opt in ('-h', '--help'):
                 printHelp(logger)
-                sys.exit(0)
+                return 0
     
-    except getopt.GetoptError:
+    except (getopt.GetoptError, ValueError):
         logger.error("wrong arguments!")
         printHelp(logger)
-        sys.exit(1)
+        return 1
 
-    if (not inputFile) and (not timeStep):
+    inputFiles = expandInputs(inputSpecs + rem)
+    if not inputFiles:
         logger.error("wrong number of arguments!")
         printHelp(logger)
-        sys.exit(1)    
+        return 1
+    if not outputFile:
+        outputFile = inputFiles[0] + ".nc"
     
         
     #############################################################
@@ -101,104 +1079,24 @@ if __name__ == "__main__":
     #############################################################
 
     logger.debug("Starting processing")
+    try:
+        failed = convertRel(inputFiles, outputFile, variablesSpec, timeStep, workers, storage, packSpec, append, chunkRows)
+    except ValueError as e:
+        logger.error(str(e))
+        return 1
 
-    # open the output netCDF4 file
-    logger.debug("Initialising output netCDF4 file")
-    ds = Dataset(outputFile, "w")
-
-    # TODO
-    logger.debug("Setting attributes")
+    # Bye!
+    if failed:
+        logger.error("%s file(s) failed: %s" % (len(failed), ", ".join(failed)))
+        return 1
+    logger.debug("Processing completed")
+    return 0
 
-    # create dimensions lat, lon, time
-    logger.debug("Creating dimensions")
-    ds.createDimension("lat")
-    ds.createDimension("lon")
-    ds.createDimension("time")
 
-    # create variables
-    logger.debug("Creating variables")
-    lat_var = ds.createVariable("lat", np.float32, ("lat",))
-    lon_var = ds.createVariable("lon", np.float32, ("lon",))
-    time_var = ds.createVariable("time", np.int32, ("time",))
-    u10m_var = ds.createVariable("U10M", np.float32, ("time", "lat", "lon",))
-    v10m_var = ds.createVariable("V10M", np.float32, ("time", "lat", "lon",))
-
-    # start filling variables...
-    logger.debug("Filling variables")
-
-    # 1. initialize empty numpy arays
-    # NOTE: we use set to get rid of repetitions
-    lat_set = set()
-    lon_set = set()
-
-    # 1.1 convert rel to csv file
-    bash_command = "cat %s | tr -s \" \" | tr \" \" \",\" | grep -v \"[a-z]\" | tail -n +2 | sed s/^,// > %s" % (inputFile, csvFile)
-    subprocess.run(bash_command, shell=True)
-
-    # 2. open csv file
-    csv_fd = open(csvFile)
-    csv_reader = csv.reader(csv_fd, delimiter=",")
-
-    # 3. set the timestep
-    print(timeStep)
-    td = datetime.fromisoformat(timeStep)
-    dd = date2num(td, "hours since 1950-01-01 00:00")
-    time_var[:] = [dd]
-
-    # 4. read and copy latitude and longitude of every line
-    #    but also take the value of U10M and V10M
-    u10_values = {}
-    v10_values = {}
-    for row in csv_reader:
-        lat_set.add(row[0])
-        lon_set.add(row[1])
-
-        # fill u10_values data structure
-        if not (row[0] in u10_values.keys()):
-            u10_values[row[0]] = {}
-        if not (row[1] in u10_values[row[0]].keys()):
-            u10_values[row[0]][row[1]] = row[5]
-            
-        # fill v10_values data structure
-        if not (row[0] in v10_values.keys()):
-            v10_values[row[0]] = {}
-        if not (row[1] in v10_values[row[0]].keys()):
-            v10_values[row[0]][row[1]] = row[6]
-            
-    lat_list = sorted(lat_set)[:]
-    lon_list = sorted(lon_set)[:]
-    lat_var[:] = lat_list
-    lon_var[:] = lon_list
-    
-    # 5. read and copy U10M and V10M variables        
-    u_np_lat = []
-    v_np_lat = []
-    
-    for curr_lat in lat_list:
-        
-        u_np_lon = []
-        v_np_lon = []
-        
-        for curr_lon in lon_list:
+if __name__ == "__main__":
 
-            try:
-                u_np_lon.append(u10_values[curr_lat][curr_lon])
-                v_np_lon.append(v10_values[curr_lat][curr_lon])
-                
-            except KeyError:
-                u_np_lon.append(float("nan"))
-                v_np_lon.append(float("nan"))
-                
-        u_np_lat.append(np.array(u_np_lon))
-        v_np_lat.append(np.array(v_np_lon))
-        
-    u_np_lat = np.array(u_np_lat)
-    v_np_lat = np.array(v_np_lat)
+    # configure logger
+    logging.basicConfig(level=logging.DEBUG)
+    logger.setLevel(logging.DEBUG)
 
-    # push data into netCDF variables U10M and V10M
-    u10m_var[0,:,:] = u_np_lat[:,:]
-    v10m_var[0,:,:] = v_np_lat[:,:]
-    
-    # Bye!
-    logger.debug("Processing completed")
-    ds.close()
+    sys.exit(main(sys.argv[1:]))
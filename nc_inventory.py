@@ -0,0 +1,425 @@
+#!/usr/bin/python3
+#
+# This script builds an inventory of NetCDF archives. Files are
+# found walking directory trees and only their headers are read
+# (dimensions, variables, dtypes, chunking, compression) along
+# with the first/last values of the time and lat/lon coordinate
+# axes, to get the time coverage and the bounding box. Results
+# are stored in a SQLite index, so that the files covering a
+# region and/or a period can be found without opening them.
+#
+
+
+#############################################################
+#
+# requirements
+#
+#############################################################
+
+# global reqs
+import os
+import sys
+import glob
+import json
+import fnmatch
+import getopt
+import sqlite3
+import logging
+import multiprocessing
+import numpy as np
+from netCDF4 import num2date
+
+# local reqs
+import nc_reader
+
+# defaults
+DEFAULT_DATABASE = "inventory.sqlite"
+NC_EXTENSIONS = (".nc", ".nc4", ".cdf", ".netcdf")
+
+# records written to the index at once
+BATCH_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, size INTEGER, mtime REAL, format TEXT,
+    latMin REAL, latMax REAL, lonMin REAL, lonMax REAL,
+    timeStart TEXT, timeEnd TEXT, nSteps INTEGER, error TEXT);
+CREATE TABLE IF NOT EXISTS dimensions (
+    path TEXT, name TEXT, size INTEGER, unlimited INTEGER);
+CREATE TABLE IF NOT EXISTS variables (
+    path TEXT, name TEXT, dimensions TEXT, shape TEXT, dtype TEXT,
+    chunking TEXT, compression TEXT, standardName TEXT, units TEXT);
+CREATE INDEX IF NOT EXISTS filesTime ON files (timeStart, timeEnd);
+CREATE INDEX IF NOT EXISTS filesLat ON files (latMin, latMax);
+CREATE INDEX IF NOT EXISTS dimensionsPath ON dimensions (path);
+CREATE INDEX IF NOT EXISTS variablesPath ON variables (path);
+CREATE INDEX IF NOT EXISTS variablesName ON variables (name);
+"""
+
+# logger
+logger = logging.getLogger('nc_inventory')
+
+
+#############################################################
+#
+# printHelp
+#
+#############################################################
+
+def printHelp(logger):
+
+    logger.info("  This script indexes the headers of NetCDF files and queries the index.")
+    logger.info("  Parameters are:")
+    logger.info("  --input=<DIR|FILE|PATTERN[,...]> (directories are walked recursively; can be repeated)")
+    logger.info("  --database=<FILE> (SQLite index, default: %s)" % DEFAULT_DATABASE)
+    logger.info("  --workers=<N> (processes reading the headers, default: the number of CPUs)")
+    logger.info("  --query (list the indexed files matching --bbox, --start/--end and --variable)")
+    logger.info("  --bbox=<LATMIN,LATMAX,LONMIN,LONMAX>")
+    logger.info("  --start=<ISO DATE[THH:MM:SS]>")
+    logger.info("  --end=<ISO DATE[THH:MM:SS]> (default: the end of the --start day)")
+    logger.info("  --variable=<NAME> (variable name or CF standard_name)")
+
+
+#############################################################
+#
+# Scan
+#
+#############################################################
+
+def findFiles(inputs):
+
+    """Expand a list of directories, files and glob patterns
+    (comma-separated lists are accepted too) into the NetCDF files
+    they contain. Directories are walked recursively."""
+
+    for item in nc_reader.expandInputs(inputs):
+        if os.path.isdir(item):
+            for root, dirs, files in os.walk(item):
+                dirs.sort()
+                for f in sorted(files):
+                    if f.lower().endswith(NC_EXTENSIONS):
+                        yield os.path.join(root, f)
+        else:
+            yield item
+
+
+def isoTime(value, units, calendar):
+
+    """A time value decoded to an ISO string, YYYY-MM-DDTHH:MM:SS."""
+
+    return num2date(value, units, calendar).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def scanFile(path):
+
+    """Read the header of a NetCDF file. Returns a dict with the
+    fields of the files table, plus the "dimensions" and
+    "variables" lists; errors are reported in the "error" field.
+    Data arrays are never read: the bounding box and the time
+    coverage come from attributes or from the first/last values
+    of 1-D coordinates (None if these are not available)."""
+
+    stat = os.stat(path)
+    record = {"path": os.path.abspath(path), "size": stat.st_size, "mtime": stat.st_mtime, "format": None,
+              "latMin": None, "latMax": None, "lonMin": None, "lonMax": None,
+              "timeStart": None, "timeEnd": None, "nSteps": None, "error": None,
+              "dimensions": [], "variables": []}
+    try:
+        reader = nc_reader.NcReader([path])
+    except Exception as e:
+        record["error"] = "%s: %s" % (type(e).__name__, e)
+        return record
+
+    try:
+        ds = reader.datasets[0]
+        record["format"] = ds.data_model
+        for name, dim in ds.dimensions.items():
+            record["dimensions"].append((name, len(dim), int(dim.isunlimited())))
+        for name, var in ds.variables.items():
+            attrs = var.ncattrs()
+            filters = var.filters() or {}
+            compression = ",".join((["zlib(%s)" % filters["complevel"]] if filters.get("zlib") else []) +
+                                   [f for f in ("shuffle", "fletcher32") if filters.get(f)]) or "none"
+            chunking = var.chunking() if ds.data_model.startswith("NETCDF4") else "contiguous"
+            record["variables"].append((name, ",".join(var.dimensions), json.dumps(list(var.shape)), str(var.dtype),
+                                        chunking if isinstance(chunking, str) else json.dumps(list(chunking)),
+                                        compression,
+                                        var.getncattr("standard_name") if "standard_name" in attrs else None,
+                                        var.getncattr("units") if "units" in attrs else None))
+
+        # bounding box
+        for axis in ("lat", "lon"):
+            if axis in reader:
+                bounds = reader.getAxisBounds(axis, axis, full=False)
+                if bounds:
+                    record[axis + "Min"], record[axis + "Max"] = bounds
+
+        # time coverage
+        if "time" in reader:
+            var = reader["time"]
+            attrs = var.ncattrs()
+            if (var.ndim == 1) and len(var) and ("units" in attrs):
+                calendar = var.getncattr("calendar") if "calendar" in attrs else "standard"
+                first, last = sorted([var[0], var[-1]])
+                record["timeStart"] = isoTime(first, var.getncattr("units"), calendar)
+                record["timeEnd"] = isoTime(last, var.getncattr("units"), calendar)
+                record["nSteps"] = len(var)
+    except Exception as e:
+        record["error"] = "%s: %s" % (type(e).__name__, e)
+    finally:
+        reader.close()
+    return record
+
+
+def formatRecord(record):
+
+    """A human readable summary of a scanFile record."""
+
+    lines = [record["path"]]
+    if record["error"]:
+        lines.append("  error: %s" % record["error"])
+        return "\n".join(lines)
+    lines.append("  format: %s, %s bytes" % (record["format"], record["size"]))
+    lines.append("  dimensions: " + ", ".join("%s=%s%s" % (n, s, " (unlimited)" if u else "") for n, s, u in record["dimensions"]))
+    if record["latMin"] is not None:
+        lines.append("  lat: %s to %s" % (record["latMin"], record["latMax"]))
+    if record["lonMin"] is not None:
+        lines.append("  lon: %s to %s" % (record["lonMin"], record["lonMax"]))
+    if record["timeStart"]:
+        lines.append("  time: %s to %s (%s steps)" % (record["timeStart"], record["timeEnd"], record["nSteps"]))
+    lines.append("  variables:")
+    for name, dims, shape, dtype, chunking, compression, standardName, units in record["variables"]:
+        lines.append("    %s(%s) %s, chunks %s, %s%s" % (name, dims, dtype, chunking, compression,
+                                                      ", %s" % standardName if standardName else ""))
+    return "\n".join(lines)
+
+
+#############################################################
+#
+# Index
+#
+#############################################################
+
+def openIndex(dbFile):
+
+    """Open (creating it if needed) the SQLite index."""
+
+    db = sqlite3.connect(dbFile)
+    db.executescript(SCHEMA)
+    return db
+
+
+def storeRecords(db, records):
+
+    """Write scanFile records to the index, replacing the previous
+    ones of the same files."""
+
+    paths = [(r["path"],) for r in records]
+    db.executemany("DELETE FROM dimensions WHERE path = ?", paths)
+    db.executemany("DELETE FROM variables WHERE path = ?", paths)
+    db.executemany("INSERT OR REPLACE INTO files VALUES "
+                   "(:path, :size, :mtime, :format, :latMin, :latMax, :lonMin, :lonMax, :timeStart, :timeEnd, :nSteps, :error)",
+                   records)
+    db.executemany("INSERT INTO dimensions VALUES (?, ?, ?, ?)",
+                   [(r["path"],) + tuple(d) for r in records for d in r["dimensions"]])
+    db.executemany("INSERT INTO variables VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                   [(r["path"],) + tuple(v) for r in records for v in r["variables"]])
+    db.commit()
+
+
+def removeRecords(db, paths):
+
+    """Remove the files of paths from the index."""
+
+    paths = [(p,) for p in paths]
+    for table in ("files", "dimensions", "variables"):
+        db.executemany("DELETE FROM %s WHERE path = ?" % table, paths)
+    db.commit()
+
+
+def isCovered(path, inputs):
+
+    """Whether the absolute path would be found scanning inputs
+    (see findFiles): it is one of the files, lies under one of the
+    directories or matches one of the glob patterns."""
+
+    for spec in inputs:
+        for item in spec.split(","):
+            if not item:
+                continue
+            root = os.path.abspath(item)
+            if glob.has_magic(item):
+                if fnmatch.fnmatch(path, root) or fnmatch.fnmatch(path, os.path.join(root, "*")):
+                    return True
+            elif (path == root) or path.startswith(root.rstrip(os.sep) + os.sep):
+                return True
+    return False
+
+
+def updateIndex(dbFile, inputs, workers=None):
+
+    """Scan the NetCDF files found in inputs (see findFiles) and
+    store their headers in the index. Files already indexed with
+    the same size and mtime are skipped. Headers are read by a
+    pool of workers processes, the index is written by this one.
+    Indexed files under inputs that are not found any more
+    (deleted or moved) are removed from the index.
+
+    Returns the (scanned, skipped, failed, removed) counts."""
+
+    db = openIndex(dbFile)
+    known = {path: (size, mtime) for path, size, mtime in db.execute("SELECT path, size, mtime FROM files")}
+
+    # files new or changed since the last run
+    todo = []
+    found = set()
+    skipped = 0
+    for path in findFiles(inputs):
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            logger.warning("Skipping %s: %s" % (path, e))
+            continue
+        found.add(os.path.abspath(path))
+        if known.get(os.path.abspath(path)) == (stat.st_size, stat.st_mtime):
+            skipped += 1
+        else:
+            todo.append(path)
+    logger.info("%s files to scan, %s unchanged" % (len(todo), skipped))
+
+    # files gone since the last run
+    gone = [path for path in known if (path not in found) and isCovered(path, inputs)]
+    if gone:
+        logger.info("Removing %s files not found any more" % len(gone))
+        removeRecords(db, gone)
+
+    # read the headers concurrently
+    failed = 0
+    batch = []
+    workers = workers or multiprocessing.cpu_count()
+    with multiprocessing.Pool(workers) as pool:
+        for n, record in enumerate(pool.imap_unordered(scanFile, todo, chunksize=16), 1):
+            if record["error"]:
+                logger.warning("Cannot read %s: %s" % (record["path"], record["error"]))
+                failed += 1
+            batch.append(record)
+            if len(batch) >= BATCH_SIZE:
+                storeRecords(db, batch)
+                batch = []
+                logger.info("%s of %s files scanned" % (n, len(todo)))
+        storeRecords(db, batch)
+    db.close()
+    return len(todo), skipped, failed, len(gone)
+
+
+def parseTime(value, end=False):
+
+    """Normalize an ISO date/time to YYYY-MM-DDTHH:MM:SS, as stored
+    in the index. A date alone is the start of the day, or its
+    end with end=True."""
+
+    t = np.datetime64(value, "s")
+    if end and (len(value) <= 10):
+        t += np.timedelta64(1, "D") - np.timedelta64(1, "s")
+    return str(t)
+
+
+def queryIndex(dbFile, bbox=None, start=None, end=None, variable=None):
+
+    """Paths of the indexed files intersecting the (latMin, latMax,
+    lonMin, lonMax) bbox and the [start, end] period (ISO strings,
+    see parseTime) and containing variable (a name or a CF
+    standard_name). Files without the needed metadata are left
+    out when a condition on it is given."""
+
+    where, args = ["error IS NULL"], []
+    if bbox:
+        where.append("latMax >= ? AND latMin <= ? AND lonMax >= ? AND lonMin <= ?")
+        args += [bbox[0], bbox[1], bbox[2], bbox[3]]
+    if start or end:
+        where.append("timeEnd >= ? AND timeStart <= ?")
+        args += [parseTime(start or end), parseTime(end or start, end=True)]
+    if variable:
+        where.append("path IN (SELECT path FROM variables WHERE name = ? OR standardName = ?)")
+        args += [variable, variable]
+
+    db = openIndex(dbFile)
+    try:
+        rows = db.execute("SELECT path FROM files WHERE %s ORDER BY timeStart, path" % " AND ".join(where), args).fetchall()
+    finally:
+        db.close()
+    return [row[0] for row in rows]
+
+
+#############################################################
+#
+# Main
+#
+#############################################################
+
+def main(argv):
+
+    """Command line interface: parse argv (without the program
+    name), update or query the index and return the exit status."""
+
+    inputs = []
+    dbFile = DEFAULT_DATABASE
+    workers = None
+    query = False
+    bbox = start = end = variable = None
+
+    try:
+        options, rem = getopt.getopt(argv, 'hi:d:w:q', ['help', 'input=', 'database=', 'workers=', 'query',
+                                                        'bbox=', 'start=', 'end=', 'variable='])
+        for opt, arg in options:
+            if opt in ('-i', '--input'):
+                inputs.append(arg)
+            elif opt in ('-d', '--database'):
+                dbFile = arg
+            elif opt in ('-w', '--workers'):
+                workers = int(arg)
+            elif opt in ('-q', '--query'):
+                query = True
+            elif opt == '--bbox':
+                bbox = [float(x) for x in arg.split(",")]
+                if len(bbox) != 4:
+                    raise ValueError("bbox must be LATMIN,LATMAX,LONMIN,LONMAX")
+            elif opt == '--start':
+                start = arg
+            elif opt == '--end':
+                end = arg
+            elif opt == '--variable':
+                variable = arg
+            elif opt in ('-h', '--help'):
+                printHelp(logger)
+                return 0
+        if start:
+            parseTime(start)
+        if end:
+            parseTime(end)
+    except (getopt.GetoptError, ValueError):
+        logger.error("wrong arguments!")
+        printHelp(logger)
+        return 1
+
+    if query:
+        for path in queryIndex(dbFile, bbox, start, end, variable):
+            print(path)
+        return 0
+
+    if not inputs:
+        logger.error("wrong number of arguments!")
+        printHelp(logger)
+        return 1
+
+    scanned, skipped, failed, removed = updateIndex(dbFile, inputs, workers)
+    logger.info("%s files indexed in %s (%s unchanged, %s unreadable, %s removed)" % (scanned - failed, dbFile, skipped, failed, removed))
+    return 0
+
+
+if __name__ == "__main__":
+
+    # configure logger
+    logging.basicConfig(level=logging.INFO)
+
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,419 @@
+#!/usr/bin/python3
+#
+# This module gives a single view over a set of NetCDF files
+# (e.g. U and V in separate files, or a series split in time),
+# used by the visualisers. Variables are looked up by their
+# name or by a logical name (u, v, lat, lon, time, depth),
+# found through the CF standard_name/axis attributes; data is
+# read lazily, only for the requested slice, across files.
+# Open handles and decoded coordinates are cached.
+#
+
+
+#############################################################
+#
+# requirements
+#
+#############################################################
+
+import logging
+import numpy as np
+import derived_fields
+from render_cache import expandInputs
+from netCDF4 import Dataset, num2date
+
+# logger
+logger = logging.getLogger('nc_reader')
+
+# how logical names are detected: CF standard_name and axis
+# attributes first, then the usual variable names
+LOGICAL_NAMES = {
+    "lat": {"standard_names": ["latitude", "grid_latitude"], "axis": "Y", "units": ["degrees_north", "degree_north"],
+            "names": ["lat", "latitude", "nav_lat"]},
+    "lon": {"standard_names": ["longitude", "grid_longitude"], "axis": "X", "units": ["degrees_east", "degree_east"],
+            "names": ["lon", "longitude", "nav_lon"]},
+    "time": {"standard_names": ["time"], "axis": "T", "units": [],
+             "names": ["time", "time_counter", "t"]},
+    "depth": {"standard_names": ["depth"], "axis": "Z", "units": [],
+              "names": ["depth", "deptht", "depthu", "depthv", "lev"]},
+    "u": {"standard_names": ["eastward_sea_water_velocity", "sea_water_x_velocity",
+                             "surface_eastward_sea_water_velocity", "eastward_wind", "x_wind"],
+          "axis": None, "units": [], "names": ["u", "uo", "vozocrtx", "U10M", "u10"]},
+    "v": {"standard_names": ["northward_sea_water_velocity", "sea_water_y_velocity",
+                             "surface_northward_sea_water_velocity", "northward_wind", "y_wind"],
+          "axis": None, "units": [], "names": ["v", "vo", "vomecrty", "V10M", "v10"]},
+}
+
+# open Datasets, shared by all the readers, and the number of
+# readers using each of them
+handleCache = {}
+handleRefs = {}
+
+
+#############################################################
+#
+# Handles
+#
+#############################################################
+
+def openDataset(path):
+
+    """Open a NetCDF file for reading, or return the Dataset
+    already open for it. Every call must be paired with a
+    closeDataset."""
+
+    ds = handleCache.get(path)
+    if (ds is None) or (not ds.isopen()):
+        ds = handleCache[path] = Dataset(path, "r")
+        handleRefs[path] = 0
+    handleRefs[path] += 1
+    return ds
+
+
+def closeDataset(path):
+
+    """Release the Dataset of a file, closing it when no other
+    reader uses it."""
+
+    handleRefs[path] = handleRefs.get(path, 1) - 1
+    if handleRefs[path] > 0:
+        return
+    handleRefs.pop(path, None)
+    ds = handleCache.pop(path, None)
+    if (ds is not None) and ds.isopen():
+        ds.close()
+
+
+#############################################################
+#
+# Lazy variables
+#
+#############################################################
+
+class MultiFileVariable:
+
+    """A variable split along its first (time) dimension across
+    files, seen as a single one. Indexing reads only the files
+    and the slices involved; the other dimensions are passed
+    to netCDF4 as they are."""
+
+    def __init__(self, name, segments):
+
+        # segments are (Dataset, number of steps) tuples, in order
+        self.name = name
+        self.segments = segments
+        first = segments[0][0].variables[name]
+        self.dimensions = first.dimensions
+        self.dtype = first.dtype
+        self.ndim = first.ndim
+        self.shape = first.shape
+        if len(segments) > 1:
+            self.shape = (sum(n for ds, n in segments),) + first.shape[1:]
+        self.offsets = np.cumsum([0] + [n for ds, n in segments])
+
+    def ncattrs(self):
+        return self.segments[0][0].variables[self.name].ncattrs()
+
+    def getncattr(self, attr):
+        return self.segments[0][0].variables[self.name].getncattr(attr)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+
+        if len(self.segments) == 1:
+            return self.segments[0][0].variables[self.name][key]
+
+        key = key if isinstance(key, tuple) else (key,)
+        head, rest = (key[0], key[1:]) if key else (slice(None), ())
+
+        # a single step comes from a single file
+        if isinstance(head, (int, np.integer)):
+            index = range(self.shape[0])[head]
+            seg = int(np.searchsorted(self.offsets, index, "right")) - 1
+            return self.segments[seg][0].variables[self.name][(index - self.offsets[seg],) + rest]
+
+        # otherwise read the steps of every file involved, in
+        # increasing order, then put them in the requested one
+        indices = np.arange(self.shape[0])[head]
+        steps, order = np.unique(indices, return_inverse=True)
+        segs = np.searchsorted(self.offsets, steps, "right") - 1
+        parts = []
+        for seg in np.unique(segs):
+            local = steps[segs == seg] - self.offsets[seg]
+            if (len(local) == 1) or np.all(np.diff(local) == local[1] - local[0]):
+                local = slice(int(local[0]), int(local[-1]) + 1, int(local[1] - local[0]) if len(local) > 1 else 1)
+            parts.append(self.segments[seg][0].variables[self.name][(local,) + rest])
+        if not parts:
+            return self.segments[0][0].variables[self.name][(slice(0, 0),) + rest]
+        data = np.ma.concatenate(parts, axis=0)
+        if not np.array_equal(steps, indices):
+            data = data[order]
+        return data
+
+
+#############################################################
+#
+# Reader
+#
+#############################################################
+
+class NcReader:
+
+    """Read-only view of a set of NetCDF files.
+
+    inputs is a list of file names and/or glob patterns (comma
+    separated lists are accepted too); names maps logical names
+    to actual variable names, overriding the detection. A
+    variable found in more files is concatenated along time,
+    files being sorted by their first time value; files with
+    the same first time value (or without a time coordinate)
+    are alternatives, the variable is taken from the first."""
+
+    def __init__(self, inputs, names=None):
+
+        self.files = expandInputs([inputs] if isinstance(inputs, str) else inputs)
+        if not self.files:
+            raise IOError("No input files found in %s" % (inputs,))
+        self.names = dict(names or {})
+        self.coordinates = {}
+        self.derived = {}
+        self.boundaries = None
+
+        # collect the variables of every file
+        # (files with the same start time, e.g. U and V of the
+        # same period, are not concatenated)
+        datasets = [openDataset(f) for f in self.files]
+        starts = [self.startTime(ds) for ds in datasets]
+        order = sorted(range(len(datasets)), key=lambda i: (starts[i], i))
+        pieces = {}
+        pieceStarts = {}
+        for i in order:
+            ds = datasets[i]
+            for name, var in ds.variables.items():
+                if (name in pieces) and ((not self.isTimeSplit(ds, var)) or (starts[i] in pieceStarts[name])):
+                    continue
+                pieces.setdefault(name, []).append((ds, var.shape[0] if var.ndim else 0))
+                pieceStarts.setdefault(name, set()).add(starts[i])
+        self.variables = {name: MultiFileVariable(name, segments) for name, segments in pieces.items()}
+        self.datasets = [datasets[i] for i in order]
+        logger.debug("Reading %s variables from %s files" % (len(self.variables), len(self.files)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+
+        """Close the files of the reader (those still used by
+        other readers stay open for them)."""
+
+        if self.datasets is None:
+            return
+        for f in self.files:
+            closeDataset(f)
+        self.datasets = None
+
+
+    #########################################################
+    #
+    # Variable lookup
+    #
+    #########################################################
+
+    def startTime(self, ds):
+
+        """First time value of a Dataset, decoded, used to sort
+        time-split files (None if there is no time coordinate)."""
+
+        for name, var in ds.variables.items():
+            attrs = var.ncattrs()
+            if (var.ndim == 1) and (len(var) > 0) and ("units" in attrs) and " since " in var.units and \
+               ((getattr(var, "standard_name", None) == "time") or (getattr(var, "axis", None) == "T") or (name == var.dimensions[0])):
+                try:
+                    return num2date(var[0], var.units, getattr(var, "calendar", "standard")).isoformat()
+                except (ValueError, TypeError, AttributeError):
+                    return ""
+        return ""
+
+    def isTimeSplit(self, ds, var):
+
+        """True if var is split along its first dimension across
+        files, i.e. its first dimension is the time dimension: one
+        with a time name, or unlimited and not a spatial one (e.g.
+        the lat/lon dimensions written by mdktxt_to_nc.py)."""
+
+        if not var.ndim:
+            return False
+        name = var.dimensions[0]
+        if name in LOGICAL_NAMES["time"]["names"]:
+            return True
+        spatial = [n for axis in ("lat", "lon", "depth") for n in LOGICAL_NAMES[axis]["names"]]
+        return ds.dimensions[name].isunlimited() and (name not in spatial)
+
+    def resolve(self, name):
+
+        """Actual name of a variable, given its name or a logical
+        one (u, v, lat, lon, time, depth). Raises KeyError if it
+        cannot be found."""
+
+        if name in self.names:
+            name = self.names[name]
+        if name in self.variables:
+            return name
+        if name not in LOGICAL_NAMES:
+            raise KeyError(name)
+
+        rules = LOGICAL_NAMES[name]
+        candidates = []
+        for varName, var in self.variables.items():
+            attrs = var.ncattrs()
+            attr = lambda a: var.getncattr(a) if a in attrs else None
+            if attr("standard_name") in rules["standard_names"]:
+                rank = 0
+            elif rules["axis"] and (attr("axis") == rules["axis"]):
+                rank = 1
+            elif attr("units") in rules["units"]:
+                rank = 2
+            elif varName in rules["names"]:
+                rank = 3
+            else:
+                continue
+            # 1-D coordinate variables are preferred to 2-D ones
+            candidates.append((rank, var.ndim if rules["axis"] else 0, varName))
+        if not candidates:
+            raise KeyError(name)
+        varName = min(candidates)[2]
+        logger.debug("Using %s as %s" % (varName, name))
+        self.names[name] = varName
+        return varName
+
+    def __getitem__(self, name):
+
+        """A variable by name or logical name; the derived fields
+        (speed, direction, vorticity, see derived_fields.py) of
+        the u/v pair are given as lazy variables, unless the files
+        have variables with those names."""
+
+        try:
+            return self.variables[self.resolve(name)]
+        except KeyError:
+            if name not in derived_fields.ATTRIBUTES:
+                raise
+        return self.derivedField(name)
+
+    def derivedField(self, name, uVar="u", vVar="v"):
+
+        """The derived field name of the uVar/vVar pair, computed
+        lazily when indexed (see derived_fields.DerivedVariable)."""
+
+        key = (name, uVar, vVar)
+        if key not in self.derived:
+            self.derived[key] = derived_fields.DerivedVariable(self, name, uVar, vVar)
+        return self.derived[key]
+
+    def __contains__(self, name):
+        try:
+            self.resolve(name)
+            return True
+        except KeyError:
+            return False
+
+    def ncattrs(self):
+        return self.datasets[0].ncattrs()
+
+    def getncattr(self, attr):
+        return self.datasets[0].getncattr(attr)
+
+
+    #########################################################
+    #
+    # Coordinates
+    #
+    #########################################################
+
+    def coordinate(self, name):
+
+        """The values of a coordinate (by logical or actual name),
+        read once and cached. 2-D lat/lon of rectilinear grids are
+        reduced to the 1-D axes; raises ValueError for curvilinear
+        grids, which have none."""
+
+        varName = self.resolve(name)
+        if varName not in self.coordinates:
+            values = self.readCoordinate(varName)
+            if (values.ndim == 2) and (name in ("lat", "lon")):
+                axis = values[:, 0] if name == "lat" else values[0, :]
+                grid = axis[:, np.newaxis] if name == "lat" else axis[np.newaxis, :]
+                if not np.ma.allclose(values, grid):
+                    raise ValueError("%s: %s varies along both dimensions, the grid is not rectilinear" % (", ".join(self.files), varName))
+                values = axis
+            self.coordinates[varName] = values
+        return self.coordinates[varName]
+
+    def readCoordinate(self, varName):
+
+        """All the values of a coordinate variable (2-D ones too),
+        read once and cached."""
+
+        key = ("full", varName)
+        if key not in self.coordinates:
+            self.coordinates[key] = self.variables[varName][:]
+        return self.coordinates[key]
+
+    def times(self):
+
+        """The time coordinate decoded to datetimes (cached)."""
+
+        key = ("decoded", self.resolve("time"))
+        if key not in self.coordinates:
+            var = self["time"]
+            self.coordinates[key] = num2date(self.coordinate("time"), var.getncattr("units"),
+                                             var.getncattr("calendar") if "calendar" in var.ncattrs() else "standard")
+        return self.coordinates[key]
+
+    def getAxisBounds(self, name, axis, full=True):
+
+        """Get the min/max of a coordinate reading as little as
+        possible: the actual_range attribute or the geospatial_*
+        global attributes if present, the first/last elements of a
+        1-D coordinate variable (monotonic by definition), the
+        valid_min/valid_max attributes and, only as a last resort
+        (unless full is False, then None is returned), the whole
+        array (2-D too, for curvilinear grids), read once."""
+
+        varName = self.resolve(name)
+        var = self.variables[varName]
+        attrs = var.ncattrs()
+        globalAttrs = self.ncattrs()
+        if "actual_range" in attrs:
+            vmin, vmax = var.getncattr("actual_range")
+        elif ("geospatial_%s_min" % axis in globalAttrs) and ("geospatial_%s_max" % axis in globalAttrs):
+            vmin = self.getncattr("geospatial_%s_min" % axis)
+            vmax = self.getncattr("geospatial_%s_max" % axis)
+        elif (var.ndim == 1) and (var.dimensions[0] == varName):
+            vmin, vmax = sorted([var[0], var[-1]])
+        elif ("valid_min" in attrs) and ("valid_max" in attrs):
+            vmin, vmax = var.getncattr("valid_min"), var.getncattr("valid_max")
+        elif not full:
+            return None
+        else:
+            values = self.readCoordinate(varName)
+            vmin, vmax = values.min(), values.max()
+        return float(vmin), float(vmax)
+
+    def getBoundaries(self):
+
+        """The (latMin, latMax, lonMin, lonMax) bounds of the
+        files, computed once."""
+
+        if self.boundaries is None:
+            latMin, latMax = self.getAxisBounds("lat", "lat")
+            lonMin, lonMax = self.getAxisBounds("lon", "lon")
+            logger.debug("Latitude bounds are %s and %s" % (latMin, latMax))
+            logger.debug("Longitude bounds are %s and %s" % (lonMin, lonMax))
+            self.boundaries = latMin, latMax, lonMin, lonMax
+        return self.boundaries
@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+#
+# This module keeps the images rendered by the visualisers in a
+# directory, so that the same plot of the same data is served
+# again without opening the NetCDF files nor loading matplotlib
+# and Basemap. Entries are keyed by the source files (path, size
+# and mtime) and the rendering parameters; entries of files that
+# changed since are removed, and the least recently used ones
+# are evicted when the directory grows over its size limit.
+# Only the standard library is used, to keep hits fast.
+#
+
+
+#############################################################
+#
+# requirements
+#
+#############################################################
+
+import os
+import re
+import glob
+import json
+import shutil
+import hashlib
+import logging
+
+# default size limit of the cache directory (MB)
+DEFAULT_CACHE_SIZE = 512
+
+# names of the cache entries (see entryName): other files in the
+# directory are never removed
+ENTRY_NAME = re.compile(r"^[0-9a-f]{20}-[0-9a-f]{20}-[0-9a-f]{20}\.\w+$")
+
+# logger
+logger = logging.getLogger('render_cache')
+
+
+#############################################################
+#
+# Keys
+#
+#############################################################
+
+def expandInputs(specs):
+
+    """Expand a list of comma-separated file names and/or glob
+    patterns into the list of matching files. Shared by the
+    readers and converters (it lives here, as this module only
+    needs the standard library)."""
+
+    inputFiles = []
+    for spec in specs:
+        for item in spec.split(","):
+            if glob.has_magic(item):
+                inputFiles += sorted(glob.glob(item))
+            elif item:
+                inputFiles.append(item)
+    return inputFiles
+
+
+def sourceFiles(inputs):
+
+    """The (path, size, mtime) tuples of the files of inputs (see
+    expandInputs). Raises OSError if a file is missing."""
+
+    files = []
+    for path in expandInputs(inputs):
+        stat = os.stat(path)
+        files.append((os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+    return files
+
+
+def entryName(inputs, params, ext=".png"):
+
+    """Name of the cache entry of a rendering: the hash of the
+    source paths, the hash of their size/mtime and the hash of
+    the params dict (which must be JSON serialisable), so that
+    entries of changed files can be found by their prefix."""
+
+    files = sourceFiles(inputs)
+    digest = lambda value: hashlib.sha1(json.dumps(value, sort_keys=True).encode()).hexdigest()[:20]
+    return "%s-%s-%s%s" % (digest([f[0] for f in files]), digest(files), digest(params), ext)
+
+
+#############################################################
+#
+# Lookup / store
+#
+#############################################################
+
+def fetch(cacheDir, inputs, params, outputFile):
+
+    """Copy the cached rendering of inputs with params to
+    outputFile. Returns True on a hit, False otherwise (also if
+    the sources cannot be read, so that the caller reports the
+    error)."""
+
+    try:
+        entry = os.path.join(cacheDir, entryName(inputs, params, os.path.splitext(outputFile)[1]))
+        shutil.copyfile(entry, outputFile)
+    except OSError:
+        return False
+
+    # the mtime of an entry is its last use
+    os.utime(entry)
+    logger.debug("%s served from %s" % (outputFile, entry))
+    return True
+
+
+def store(cacheDir, inputs, params, outputFile, maxSize=DEFAULT_CACHE_SIZE):
+
+    """Add the rendered outputFile to the cache, remove the
+    entries of older versions of the same sources and evict the
+    least recently used entries beyond maxSize MB."""
+
+    try:
+        name = entryName(inputs, params, os.path.splitext(outputFile)[1])
+    except OSError as e:
+        logger.warning("Not caching %s: %s" % (outputFile, e))
+        return
+    os.makedirs(cacheDir, exist_ok=True)
+    entry = os.path.join(cacheDir, name)
+    tmpFile = "%s.%s.tmp" % (entry, os.getpid())
+    shutil.copyfile(outputFile, tmpFile)
+    os.replace(tmpFile, entry)
+
+    # the sources changed: older renderings are stale
+    sources, state = name.split("-")[:2]
+    for stale in glob.glob(os.path.join(cacheDir, sources + "-*")):
+        if ENTRY_NAME.match(os.path.basename(stale)) and (os.path.basename(stale).split("-")[1] != state):
+            logger.debug("Removing stale %s" % stale)
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+
+    evict(cacheDir, maxSize)
+
+
+def evict(cacheDir, maxSize=DEFAULT_CACHE_SIZE):
+
+    """Remove the least recently used entries until they are
+    within maxSize MB (other files in cacheDir, e.g. the Basemaps
+    of --cacheDir, are not counted). Returns the number of
+    removed entries."""
+
+    entries = []
+    for dirEntry in os.scandir(cacheDir):
+        if dirEntry.is_file() and ENTRY_NAME.match(dirEntry.name):
+            stat = dirEntry.stat()
+            entries.append((stat.st_mtime, stat.st_size, dirEntry.path))
+    total = sum(size for mtime, size, path in entries)
+
+    removed = 0
+    for mtime, size, path in sorted(entries):
+        if total <= maxSize * 1024 * 1024:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    if removed:
+        logger.debug("Evicted %s entries from %s" % (removed, cacheDir))
+    return removed
@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+#
+# Tests of the variables specification of mdktxt_to_nc.py.
+# Run with: python -m pytest test_mdktxt_to_nc.py
+#
+
+
+#############################################################
+#
+# requirements
+#
+#############################################################
+
+import pytest
+import mdktxt_to_nc
+
+# columns of a Medslik-II .rel file
+COLUMNS = ["lat", "lon", "SST", "u_srf", "v_srf", "u_10m", "v_10m"]
+
+
+#############################################################
+#
+# parseVariables
+#
+#############################################################
+
+def test_parseVariables():
+    assert mdktxt_to_nc.parseVariables("u_srf,v_srf:V", COLUMNS) == [("u_srf", "u_srf"), ("v_srf", "V")]
+    assert mdktxt_to_nc.parseVariables("speed_srf", COLUMNS) == [("speed_srf", "speed_srf")]
+
+
+def test_parseVariables_repeated_column():
+    with pytest.raises(ValueError):
+        mdktxt_to_nc.parseVariables("u_srf,u_srf", COLUMNS)
+
+
+def test_parseVariables_repeated_name():
+    with pytest.raises(ValueError):
+        mdktxt_to_nc.parseVariables("u_srf:X,v_srf:X", COLUMNS)
+
+
+@pytest.mark.parametrize("spec", ["lat", "lon", "lat:LAT"])
+def test_parseVariables_coordinate_column(spec):
+    with pytest.raises(ValueError):
+        mdktxt_to_nc.parseVariables(spec, COLUMNS)
+
+
+@pytest.mark.parametrize("spec", ["time", "u_srf:time", "u_srf:lat", "v_srf:lon"])
+def test_parseVariables_coordinate_name(spec):
+    with pytest.raises(ValueError):
+        mdktxt_to_nc.parseVariables(spec, COLUMNS)